@@ -1,19 +1,341 @@
-from datetime import datetime, timedelta, tzinfo
-from typing import Dict, List, Optional
-from requests_oauthlib import OAuth1Session
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import (TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Iterable,
+                    Iterator, List, Mapping, NamedTuple, Optional, Sequence,
+                    Set, Tuple, Union)
 
+import abc
+import array
+import bisect
 import click
-import dateutil.parser
-import pytz
-import requests
-import textwrap
+import codecs
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import string
+import struct
+import tempfile
+import threading
+import time
+
+# requests, requests_oauthlib, dateutil, pytz は読み込みが遅いので、
+# 必要になった時点で読み込む
+if TYPE_CHECKING:
+    import asyncio
+    import requests
+    import sqlite3
 
 WEEKDAY_NAMES = ['月', '火', '水', '木', '金', '土', '日']
 
+WEEKDAY_NAMES_BY_LOCALE = {
+    "ja": WEEKDAY_NAMES,
+    "en": ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+}
+
 SCHEDULE_LINK = 'https://camph.net/schedule/'
 
+CATEGORIES = ["open", "make", "online open", "other"]
+
+DEFAULT_TITLE_CATEGORIES = {
+    "Open": "open",
+    "Make": "make",
+    "Online Open": "online open",
+}
+
+FEED_CHUNK_SIZE = 64 * 1024
+
+# フィードのデコーダ。"auto" はインストールされている中で最初のものを使う
+JSON_BACKENDS = ["orjson", "msgspec", "stdlib"]
+
+TWITTER_ENDPOINT = "https://api.twitter.com/2/tweets"
+
+# ツイートの長さの上限。URL は長さによらず 23 文字、全角文字は 2 文字と数える
+TWEET_MAX_LENGTH = 280
+TWEET_URL_LENGTH = 23
+
+MESSAGES: Dict[str, Dict[str, str]] = {
+    "ja": {
+        "day_open": "本日の CAMPHOR- HOUSE の開館時間は{start}〜{end}です。\n",
+        "day_make_same": "CAMPHOR- Make も利用できます。\n",
+        "day_make": "CAMPHOR- Make は{start}〜{end}に利用できます。\n",
+        "day_open_footer": "みなさんのお越しをお待ちしています!!\n"
+                           "HOUSEの場所はこちら\nhttps://goo.gl/maps/qasTRtgjnoP2",
+        "day_online_open": "本日の CAMPHOR- HOUSE のオンライン開館時間は"
+                           "{start}〜{end}です。\n"
+                           "詳しくはCAMPHOR-のSlackをご覧ください!!\n",
+        "day_other": "「{title}」を{start}〜{end}に開催します!\n"
+                     "みなさんのお越しをお待ちしています!!",
+        "week_open_header": "今週の開館日です！\n",
+        "week_make_mark": " (Make)",
+        "week_open_footer": "\nみなさんのお越しをお待ちしています!!\n",
+        "week_online_open_header": "今週のオンライン開館日です！\n",
+        "week_online_open_footer": "\n詳しくはCAMPHOR-のSlackをご覧ください!!\n",
+        "week_other_header": "今週のイベント情報です！\n",
+        "week_other_footer": "\nお申し込みの上ご参加ください。\n"
+                             "みなさんのお越しをお待ちしています!!",
+        "schedule_link": "\nその他の開館日はこちら\n{link}",
+        "day_and_time": "{date} ({weekday}) {start}〜{end}",
+        "reminder": "「{title}」が{minutes}分後の{start}から始まります!"
+                    " ({start}〜{end})",
+    },
+    "en": {
+        "day_open": "CAMPHOR- HOUSE is open today from {start} to {end}.\n",
+        "day_make_same": "CAMPHOR- Make is also available.\n",
+        "day_make": "CAMPHOR- Make is available from {start} to {end}.\n",
+        "day_open_footer": "We look forward to seeing you!!\n"
+                           "Here is the way to HOUSE\n"
+                           "https://goo.gl/maps/qasTRtgjnoP2",
+        "day_online_open": "CAMPHOR- HOUSE is open online today from "
+                           "{start} to {end}.\n"
+                           "See the CAMPHOR- Slack for details!!\n",
+        "day_other": "We are holding \"{title}\" from {start} to {end}!\n"
+                     "We look forward to seeing you!!",
+        "week_open_header": "Open days of CAMPHOR- HOUSE this week!\n",
+        "week_make_mark": " (Make)",
+        "week_open_footer": "\nWe look forward to seeing you!!\n",
+        "week_online_open_header": "Online open days of CAMPHOR- HOUSE "
+                                   "this week!\n",
+        "week_online_open_footer": "\nSee the CAMPHOR- Slack for details!!\n",
+        "week_other_header": "Events this week!\n",
+        "week_other_footer": "\nPlease sign up before joining.\n"
+                             "We look forward to seeing you!!",
+        "schedule_link": "\nOther open days are listed here\n{link}",
+        "day_and_time": "{date} ({weekday}) {start}-{end}",
+        "reminder": "\"{title}\" starts in {minutes} minutes!"
+                    " ({start}-{end})",
+    },
+}
+
+_DATE_PREFIX_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_WHITESPACE_RE = re.compile(r"[ \t\r\n]*")
+_ISO_DATETIME_RE = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})"
+    r"(?:(Z)|([+-])(\d{2}):(\d{2}))\Z")
+
+_FIXED_TIMEZONES: Dict[int, tzinfo] = {0: timezone.utc}
+
+_END = object()
+
+# スナップショットのヘッダ: マジック、版、件数、文字列の数、文字列表の位置
+_SNAPSHOT_HEADER = struct.Struct("<4sHHIIQ")
+_SNAPSHOT_MAGIC = b"CSNS"
+_SNAPSHOT_VERSION = 1
+# 1 件分: 開始・終了の epoch 秒、それぞれの UTC オフセット、タイトルと URL の番号
+_SNAPSHOT_RECORD = struct.Struct("<qqiiii")
+_SNAPSHOT_START = struct.Struct("<q")
+_SNAPSHOT_STRING_OFFSETS = struct.Struct("<QQ")
+
+# テンプレートごとに使える置換フィールド
+TEMPLATE_FIELDS: Dict[str, Set[str]] = {
+    "day_open": {"start", "end"},
+    "day_make_same": set(),
+    "day_make": {"start", "end"},
+    "day_open_footer": set(),
+    "day_online_open": {"start", "end"},
+    "day_other": {"title", "start", "end"},
+    "week_open_header": set(),
+    "week_make_mark": set(),
+    "week_open_footer": set(),
+    "week_online_open_header": set(),
+    "week_online_open_footer": set(),
+    "week_other_header": set(),
+    "week_other_footer": set(),
+    "schedule_link": {"link"},
+    "day_and_time": {"date", "weekday", "start", "end"},
+    "reminder": {"title", "minutes", "start", "end"},
+}
+
+_URL_RE = re.compile(r"https?://\S+")
+# Twitter が 1 文字と数える文字の範囲。それ以外は 2 文字と数える
+_TWEET_NARROW_RANGES = ((0x0000, 0x10FF), (0x2000, 0x200D),
+                        (0x2010, 0x201F), (0x2032, 0x2037))
+
+
+class MessageTemplate:
+    # 書式文字列を一度だけ解析し、リテラルとフィールド名の組の列にしておく
+    __slots__ = ("source", "fields", "_plan")
+
+    source: str
+    fields: Set[str]
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.fields = set()
+        plan: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in string.Formatter().parse(
+                source):
+            if spec or conversion:
+                raise ValueError(
+                    f"Only plain {{name}} fields are supported: '{source}'")
+            if field is not None:
+                if not field.isidentifier():
+                    raise ValueError(
+                        f"Invalid field '{{{field}}}' in '{source}'")
+                self.fields.add(field)
+            plan.append((literal, field))
+        self._plan = tuple(plan)
+
+    def render(self, **values: Any) -> str:
+        out: List[str] = []
+        self.render_into(out, **values)
+        return "".join(out)
+
+    def render_into(self, out: List[str], **values: Any) -> None:
+        for literal, field in self._plan:
+            if literal:
+                out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+
+
+def compile_templates(
+        catalog: Mapping[str, Mapping[str, str]]
+        ) -> Dict[str, Dict[str, MessageTemplate]]:
+    compiled: Dict[str, Dict[str, MessageTemplate]] = {}
+    for locale, sources in catalog.items():
+        missing = TEMPLATE_FIELDS.keys() - sources.keys()
+        if missing:
+            raise ValueError(f"Missing templates for '{locale}': "
+                             + ", ".join(sorted(missing)))
+        templates: Dict[str, MessageTemplate] = {}
+        for key, source in sources.items():
+            if key not in TEMPLATE_FIELDS:
+                raise ValueError(f"Unknown template '{key}'")
+            if not isinstance(source, str):
+                raise ValueError(f"Template '{key}' must be a string")
+            template = MessageTemplate(source)
+            unknown = template.fields - TEMPLATE_FIELDS[key]
+            if unknown:
+                raise ValueError(f"Unknown fields in '{key}': "
+                                 + ", ".join(sorted(unknown)))
+            templates[key] = template
+        compiled[locale] = templates
+    return compiled
+
+
+DEFAULT_TEMPLATES = compile_templates(MESSAGES)
+
+
+def load_templates(path: str) -> Dict[str, Dict[str, MessageTemplate]]:
+    # 設定ファイルには変えたいテンプレートだけを書けばよい
+    with open(path, encoding="utf-8") as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise ValueError("Templates must be an object keyed by locale")
+    catalog = {locale: dict(sources) for locale, sources in MESSAGES.items()}
+    for locale, sources in overrides.items():
+        if locale not in catalog:
+            raise ValueError(f"Unknown locale '{locale}'")
+        if not isinstance(sources, dict):
+            raise ValueError(f"Templates for '{locale}' must be an object")
+        catalog[locale].update(sources)
+    return compile_templates(catalog)
+
+
+def tweet_length(text: str) -> int:
+    length = 0
+    position = 0
+    for m in _URL_RE.finditer(text):
+        length += _weighted_length(text[position:m.start()])
+        length += TWEET_URL_LENGTH
+        position = m.end()
+    return length + _weighted_length(text[position:])
+
+
+def _weighted_length(text: str) -> int:
+    length = 0
+    for c in text:
+        code = ord(c)
+        for first, last in _TWEET_NARROW_RANGES:
+            if first <= code <= last:
+                length += 1
+                break
+        else:
+            length += 2
+    return length
+
+
+def split_text(text: str, max_length: int) -> List[str]:
+    # 行の区切りで分け、それでも長すぎる行は文字単位で分ける
+    chunks: List[str] = []
+    current = ""
+    current_length = 0
+    for line in text.splitlines(keepends=True):
+        line_length = tweet_length(line)
+        if current and current_length + line_length > max_length:
+            chunks.append(current)
+            current, current_length = "", 0
+        if line_length > max_length:
+            for c in line:
+                c_length = _weighted_length(c)
+                if current and current_length + c_length > max_length:
+                    chunks.append(current)
+                    current, current_length = "", 0
+                current += c
+                current_length += c_length
+            continue
+        current += line
+        current_length += line_length
+    if current:
+        chunks.append(current)
+    return [chunk.strip("\n") for chunk in chunks]
+
+
+class LocalizedEvent:
+    # インデックスの構築では start しか使わないので、それ以外は必要になってから作る
+    __slots__ = ("start", "tz", "_event", "_end", "_start_time", "_end_time",
+                 "_day_and_time")
+
+    start: datetime
+    tz: tzinfo
+
+    def __init__(self, event: "Event", tz: tzinfo) -> None:
+        self.start = event.start.astimezone(tz)
+        self.tz = tz
+        self._event = event
+        self._end: Optional[datetime] = None
+        self._start_time: Optional[str] = None
+        self._end_time: Optional[str] = None
+        self._day_and_time: Optional[Dict[str, str]] = None
+
+    @property
+    def end(self) -> datetime:
+        if self._end is None:
+            self._end = self._event.end.astimezone(self.tz)
+        return self._end
+
+    @property
+    def start_time(self) -> str:
+        if self._start_time is None:
+            self._start_time = self.start.strftime("%H:%M")
+        return self._start_time
+
+    @property
+    def end_time(self) -> str:
+        if self._end_time is None:
+            self._end_time = self.end.strftime("%H:%M")
+        return self._end_time
+
+    def get_day_and_time(self, locale: str = "ja") -> str:
+        if self._day_and_time is None:
+            self._day_and_time = {}
+        day_and_time = self._day_and_time.get(locale)
+        if day_and_time is None:
+            weekday = WEEKDAY_NAMES_BY_LOCALE[locale][self.start.weekday()]
+            day_and_time = DEFAULT_TEMPLATES[locale]["day_and_time"].render(
+                date=self.start.strftime("%m/%d"), weekday=weekday,
+                start=self.start_time, end=self.end_time)
+            self._day_and_time[locale] = day_and_time
+        return day_and_time
+
 
 class Event:
+    __slots__ = ("start", "end", "title", "url", "_localized")
+
     start: datetime
     end: datetime
     title: str
@@ -25,15 +347,16 @@ class Event:
         self.end = end
         self.title = title
         self.url = url
+        self._localized: Optional[Dict[tzinfo, LocalizedEvent]] = None
 
     @classmethod
     def from_json(cls, data: Dict[str, Optional[str]]) -> "Event":
         if data["start"] is not None:
-            start = dateutil.parser.parse(data["start"])
+            start = parse_datetime(data["start"])
         else:
             raise KeyError
         if data["end"] is not None:
-            end = dateutil.parser.parse(data["end"])
+            end = parse_datetime(data["end"])
         else:
             raise KeyError
         if data["title"] is not None:
@@ -42,54 +365,564 @@ class Event:
             raise KeyError
         return cls(start=start, end=end, title=title, url=data["url"])
 
+    def localize(self, tz: tzinfo) -> LocalizedEvent:
+        # タイムゾーンごとの変換と書式化は一度だけ行う
+        if self._localized is None:
+            self._localized = {}
+        localized = self._localized.get(tz)
+        if localized is None:
+            localized = LocalizedEvent(self, tz)
+            self._localized[tz] = localized
+        return localized
+
     def get_start(self, tz: tzinfo) -> str:
-        start = self.start.astimezone(tz).time().strftime("%H:%M")
-        return start
+        return self.localize(tz).start_time
 
     def get_end(self, tz: tzinfo) -> str:
-        end = self.end.astimezone(tz).time().strftime("%H:%M")
-        return end
+        return self.localize(tz).end_time
+
+    def get_day_and_time(self, tz: tzinfo, locale: str = "ja") -> str:
+        return self.localize(tz).get_day_and_time(locale)
+
+    def get_day_and_time_with_title(self, tz: tzinfo,
+                                    locale: str = "ja") -> str:
+        return f"{self.title} {self.get_day_and_time(tz, locale)}"
+
+
+class Categorizer:
+    # 正規化したタイトルからカテゴリを引く表。表にないタイトルは "other" になる
+    table: Dict[str, str]
+
+    def __init__(self, table: Optional[Mapping[str, str]] = None) -> None:
+        if table is None:
+            table = DEFAULT_TITLE_CATEGORIES
+        self.table = {}
+        for title, category in table.items():
+            if category not in CATEGORIES:
+                raise ValueError(f"Unknown category '{category}'")
+            self.table[self.normalize(title)] = category
+        # フィードには同じタイトルが何度も出てくるので、結果を覚えておく
+        self._cache: Dict[str, Optional[str]] = {}
+
+    @staticmethod
+    def normalize(title: str) -> str:
+        return title.lower()
+
+    def categorize(self, title: str) -> Optional[str]:
+        try:
+            return self._cache[title]
+        except KeyError:
+            pass
+        category = self.table.get(self.normalize(title))
+        if category is None and title.strip() != "":
+            category = "other"
+        self._cache[title] = category
+        return category
+
+    def divide(self, events: Iterable[Event]) -> Dict[str, List[Event]]:
+        events_by_title: Dict[str, List[Event]] = {c: [] for c in CATEGORIES}
+        for event in events:
+            category = self.categorize(event.title)
+            if category is not None:
+                events_by_title[category].append(event)
+        return events_by_title
+
+
+DEFAULT_CATEGORIZER = Categorizer()
+
+
+class EventTable:
+    # 開始・終了時刻を epoch 秒の配列で持ち、タイトルと URL は文字列表に集約する
+    starts: array.array
+    ends: array.array
+    start_offsets: array.array
+    end_offsets: array.array
+    title_ids: array.array
+    url_ids: array.array
+    strings: List[str]
+
+    def __init__(self) -> None:
+        self.starts = array.array("q")
+        self.ends = array.array("q")
+        self.start_offsets = array.array("i")
+        self.end_offsets = array.array("i")
+        self.title_ids = array.array("i")
+        self.url_ids = array.array("i")
+        self.strings = []
+        self._string_ids: Dict[str, int] = {}
+
+    @classmethod
+    def from_events(cls, events: Iterable[Event]) -> "EventTable":
+        table = cls()
+        for event in events:
+            table.append(event)
+        table.sort()
+        return table
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, i: int) -> Event:
+        url_id = self.url_ids[i]
+        return Event(
+            start=_from_timestamp(self.starts[i], self.start_offsets[i]),
+            end=_from_timestamp(self.ends[i], self.end_offsets[i]),
+            title=self.strings[self.title_ids[i]],
+            url=self.strings[url_id] if url_id >= 0 else None)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in
+                ["starts", "ends", "start_offsets", "end_offsets",
+                 "title_ids", "url_ids", "strings"]}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._string_ids = {s: i for i, s in enumerate(self.strings)}
+
+    def append(self, event: Event) -> None:
+        self.starts.append(int(event.start.timestamp()))
+        self.ends.append(int(event.end.timestamp()))
+        self.start_offsets.append(_utcoffset_seconds(event.start))
+        self.end_offsets.append(_utcoffset_seconds(event.end))
+        self.title_ids.append(self._intern(event.title))
+        self.url_ids.append(
+            self._intern(event.url) if event.url is not None else -1)
+
+    def sort(self) -> None:
+        order = sorted(range(len(self)), key=self.starts.__getitem__)
+        for name in ["starts", "ends", "start_offsets", "end_offsets",
+                     "title_ids", "url_ids"]:
+            column = getattr(self, name)
+            setattr(self, name, array.array(column.typecode,
+                                            (column[i] for i in order)))
+
+    def select(self, since: Optional[datetime] = None,
+               until: Optional[datetime] = None) -> List[Event]:
+        # sort() 済みであること。範囲内の行だけ Event を作る
+        lo, hi = 0, len(self)
+        if since is not None:
+            lo = bisect.bisect_left(self.starts, int(since.timestamp()))
+        if until is not None:
+            hi = bisect.bisect_left(self.starts, int(until.timestamp()), lo)
+        return [self[i] for i in range(lo, hi)]
+
+    def _intern(self, s: str) -> int:
+        i = self._string_ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self._string_ids[s] = i
+        return i
+
+
+class EventSnapshot:
+    # write_snapshot で書き出したファイルを mmap し、必要な行だけ Event にする
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._map) < _SNAPSHOT_HEADER.size:
+                raise ValueError(f"'{path}' is truncated")
+            magic, version, _, count, string_count, strings_at = \
+                _SNAPSHOT_HEADER.unpack_from(self._map, 0)
+            if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+                raise ValueError(f"'{path}' is not an event snapshot")
+            records_end = _SNAPSHOT_HEADER.size + \
+                count * _SNAPSHOT_RECORD.size
+            if records_end > strings_at or \
+                    strings_at + (string_count + 1) * 8 > len(self._map):
+                raise ValueError(f"'{path}' is truncated")
+        except ValueError:
+            self._map.close()
+            raise
+        self._count = count
+        self._strings_at = strings_at
+        self._strings_base = strings_at + (string_count + 1) * 8
+        self._strings: Dict[int, str] = {}
+
+    def __enter__(self) -> "EventSnapshot":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> Event:
+        start, end, start_offset, end_offset, title_id, url_id = \
+            _SNAPSHOT_RECORD.unpack_from(
+                self._map, _SNAPSHOT_HEADER.size + i * _SNAPSHOT_RECORD.size)
+        return Event(start=_from_timestamp(start, start_offset),
+                     end=_from_timestamp(end, end_offset),
+                     title=self._string(title_id),
+                     url=self._string(url_id) if url_id >= 0 else None)
+
+    def start_at(self, i: int) -> int:
+        return _SNAPSHOT_START.unpack_from(
+            self._map, _SNAPSHOT_HEADER.size + i * _SNAPSHOT_RECORD.size)[0]
+
+    def select(self, since: Optional[datetime] = None,
+               until: Optional[datetime] = None) -> List[Event]:
+        # 開始時刻の列をファイル上で二分探索する
+        lo, hi = 0, len(self)
+        if since is not None:
+            lo = self._bisect(int(since.timestamp()), lo, hi)
+        if until is not None:
+            hi = self._bisect(int(until.timestamp()), lo, hi)
+        return [self[i] for i in range(lo, hi)]
+
+    def _bisect(self, timestamp: int, lo: int, hi: int) -> int:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.start_at(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _string(self, i: int) -> str:
+        s = self._strings.get(i)
+        if s is None:
+            begin, end = _SNAPSHOT_STRING_OFFSETS.unpack_from(
+                self._map, self._strings_at + i * 8)
+            s = self._map[self._strings_base + begin:
+                          self._strings_base + end].decode("utf-8")
+            self._strings[i] = s
+        return s
+
+
+def write_snapshot(path: str, table: EventTable) -> None:
+    # table は sort() 済みであること
+    strings = [s.encode("utf-8") for s in table.strings]
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    strings_at = _SNAPSHOT_HEADER.size + len(table) * _SNAPSHOT_RECORD.size
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, 0, len(table),
+                len(strings), strings_at))
+            pack = _SNAPSHOT_RECORD.pack
+            for i in range(len(table)):
+                f.write(pack(table.starts[i], table.ends[i],
+                             table.start_offsets[i], table.end_offsets[i],
+                             table.title_ids[i], table.url_ids[i]))
+            f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+            for s in strings:
+                f.write(s)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EventIndex:
+    tz: tzinfo
+
+    def __init__(self, events: Iterable[Event], tz: tzinfo,
+                 categorizer: Optional[Categorizer] = None) -> None:
+        self.tz = tz
+        if categorizer is None:
+            categorizer = DEFAULT_CATEGORIZER
+        self.categorizer = categorizer
+        # カテゴリごとに開始時刻順に並べ、ローカルの日付で二分探索できるようにする
+        self._days: Dict[str, List[int]] = {c: [] for c in CATEGORIES}
+        self._events: Dict[str, List[Event]] = {c: [] for c in CATEGORIES}
+        for event in sorted(events, key=lambda e: e.start):
+            category = categorizer.categorize(event.title)
+            if category is None:
+                continue
+            day = event.localize(tz).start.date()
+            self._days[category].append(day.toordinal())
+            self._events[category].append(event)
+
+    def events_on(self, day: date) -> Dict[str, List[Event]]:
+        return self.events_between(day, day + timedelta(days=1))
+
+    def events_between(self, since: date,
+                       until: date) -> Dict[str, List[Event]]:
+        events_by_title: Dict[str, List[Event]] = {}
+        for category in CATEGORIES:
+            days = self._days[category]
+            lo = bisect.bisect_left(days, since.toordinal())
+            hi = bisect.bisect_left(days, until.toordinal(), lo)
+            events_by_title[category] = self._events[category][lo:hi]
+        return events_by_title
+
+    def iter_windows(self, since: date, until: date, days: int = 1
+                     ) -> Iterator[Tuple[date, Dict[str, List[Event]]]]:
+        # since から until の前日までの各日を起点に days 日ずつ区切り、
+        # 各カテゴリを一度だけ走査する
+        positions = {c: bisect.bisect_left(self._days[c], since.toordinal())
+                     for c in CATEGORIES}
+        for first in range(since.toordinal(), until.toordinal(), days):
+            last = first + days
+            events_by_title: Dict[str, List[Event]] = {}
+            for category in CATEGORIES:
+                ordinals = self._days[category]
+                lo = hi = positions[category]
+                while hi < len(ordinals) and ordinals[hi] < last:
+                    hi += 1
+                events_by_title[category] = self._events[category][lo:hi]
+                positions[category] = hi
+            yield date.fromordinal(first), events_by_title
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class ColumnarEventIndex(EventIndex):
+    # EventIndex と同じ問い合わせに numpy の配列で答える。
+    # EventTable を渡せば、その列をコピーせずに使う
+    def __init__(self, events: Union[Iterable[Event], EventTable],
+                 tz: tzinfo, categorizer: Optional[Categorizer] = None
+                 ) -> None:
+        import numpy as np
+        self.tz = tz
+        if categorizer is None:
+            categorizer = DEFAULT_CATEGORIZER
+        self.categorizer = categorizer
+        # タイトルの種類ごとに一度だけ分類し、カテゴリ番号 (なければ -1) を配る
+        codes: Dict[str, int] = {}
+
+        def code(title: str) -> int:
+            c = codes.get(title)
+            if c is None:
+                category = categorizer.categorize(title)
+                c = CATEGORIES.index(category) if category is not None \
+                    else -1
+                codes[title] = c
+            return c
+        if isinstance(events, EventTable):
+            self._rows: Union[Sequence[Event], EventTable] = events
+            starts = np.frombuffer(events.starts, dtype=np.int64)
+            title_ids = np.frombuffer(events.title_ids, dtype=np.int32)
+            title_codes = np.array([code(events.strings[i]) for i in
+                                    range(len(events.strings))],
+                                   dtype=np.int8)
+            self.codes = title_codes[title_ids]
+        else:
+            self._rows = sorted(events, key=lambda e: e.start)
+            starts = np.floor([e.start.timestamp()
+                               for e in self._rows]).astype(np.int64)
+            self.codes = np.array([code(e.title) for e in self._rows],
+                                  dtype=np.int8)
+        self.days = (starts + _utc_offsets(starts, tz)) // 86400 + \
+            _EPOCH_ORDINAL
+
+    def events_between(self, since: date,
+                       until: date) -> Dict[str, List[Event]]:
+        days = max((until - since).days, 1)
+        for _, events_by_title in self.iter_windows(since, until, days):
+            return events_by_title
+        return {c: [] for c in CATEGORIES}
+
+    def iter_windows(self, since: date, until: date, days: int = 1
+                     ) -> Iterator[Tuple[date, Dict[str, List[Event]]]]:
+        import numpy as np
+        first = since.toordinal()
+        n_windows = max(-(-(until.toordinal() - first) // days), 0)
+        # 最後の期間も until で切らず、days 日分を含める (EventIndex と同じ)
+        selected = np.flatnonzero((self.days >= first) &
+                                  (self.days < first + n_windows * days) &
+                                  (self.codes >= 0))
+        # (期間の番号, カテゴリ) で安定ソートし、各組の区切りを二分探索で求める
+        keys = (self.days[selected] - first) // days * len(CATEGORIES) + \
+            self.codes[selected]
+        order = np.argsort(keys, kind="stable")
+        rows = selected[order].tolist()
+        bounds = np.searchsorted(
+            keys[order], np.arange(n_windows * len(CATEGORIES) + 1)).tolist()
+        for window in range(n_windows):
+            events_by_title: Dict[str, List[Event]] = {}
+            for code, category in enumerate(CATEGORIES):
+                i = window * len(CATEGORIES) + code
+                events_by_title[category] = [
+                    self._rows[row] for row in rows[bounds[i]:bounds[i + 1]]]
+            yield date.fromordinal(first + window * days), events_by_title
+
+
+def _utc_offsets(starts: Any, tz: tzinfo) -> Any:
+    # 各 epoch 秒での tz の UTC オフセット (秒) を datetime.astimezone と同じ規則で求める
+    import numpy as np
+    transitions = getattr(tz, "_utc_transition_times", None)
+    if transitions is not None:
+        # pytz の DstTzInfo。遷移時刻の表を二分探索する
+        epoch = datetime(1970, 1, 1)
+        times = np.array([(t - epoch) // timedelta(seconds=1)
+                          for t in transitions], dtype=np.int64)
+        offsets = np.array(
+            [info[0] // timedelta(seconds=1)
+             for info in tz._transition_info],  # type: ignore
+            dtype=np.int64)
+        i = np.searchsorted(times, starts, side="right") - 1
+        return offsets[np.maximum(i, 0)]
+    offset = tz.utcoffset(None)
+    if offset is not None:
+        return np.full(len(starts), offset // timedelta(seconds=1),
+                       dtype=np.int64)
+    return np.array([_utcoffset_seconds(datetime.fromtimestamp(t, tz))
+                     for t in starts.tolist()], dtype=np.int64)
 
-    def get_day_and_time(self, tz: tzinfo) -> str:
-        date = self.start.astimezone(tz).date().strftime("%m/%d")
-        day = get_japanese_weekday(self.start.astimezone(tz).weekday())
-        return f"{date} ({day}) {self.get_start(tz)}〜{self.get_end(tz)}"
 
-    def get_day_and_time_with_title(self, tz: tzinfo) -> str:
-        return f"{self.title} {self.get_day_and_time(tz)}"
+class Target(NamedTuple):
+    tz: tzinfo
+    locale: str
+
+
+class Feed(NamedTuple):
+    url: str
+    # 秒数。None なら待ち続ける
+    timeout: Optional[float] = None
+    # 取得に失敗したとき、required でなければそのフィードを除いて続ける
+    required: bool = True
 
 
 class MessageGenerator:
     events: List[Event]
     now: datetime
     week: bool
+    locale: str
 
     def __init__(self, *, events: List[Event], now: datetime,
-                 week: bool) -> None:
+                 week: bool, locale: str = "ja",
+                 tz: Optional[tzinfo] = None,
+                 index: Optional[EventIndex] = None,
+                 categorizer: Optional[Categorizer] = None,
+                 templates: Optional[
+                     Mapping[str, Mapping[str, MessageTemplate]]] = None,
+                 max_length: Optional[int] = TWEET_MAX_LENGTH) -> None:
         self.events = events
         if now.tzinfo is None:
             raise ValueError("'now' must be timezone aware datetime")
-        self.tz = now.tzinfo
+        self.tz = tz if tz is not None else now.tzinfo
         self.now = now.astimezone(self.tz)
         self.week = week
+        if templates is None:
+            templates = DEFAULT_TEMPLATES
+        if locale not in templates:
+            raise ValueError(f"Unknown locale '{locale}'")
+        self.locale = locale
+        self.catalog = templates
+        self.templates = templates[locale]
+        self.max_length = max_length
+        if categorizer is None:
+            categorizer = DEFAULT_CATEGORIZER
+        self.categorizer = categorizer
+        if index is not None and (index.tz is not self.tz or
+                                  index.categorizer is not categorizer):
+            index = None
+        self._index = index
+
+    @property
+    def index(self) -> EventIndex:
+        if self._index is None:
+            self._index = EventIndex(self.events, self.tz, self.categorizer)
+        return self._index
 
     def generate_messages(self) -> List[str]:
+        today = self.now.date()
         if self.week:
-            delta = timedelta(days=7)
-            events = list(filter(
-                lambda e: e.start.astimezone(self.tz).date() >= self.now.date()
-                and e.start.astimezone(self.tz).date() < self.now.date()
-                + delta, self.events))
-            messages = self.generate_week_messages(events)
+            events_by_title = self.index.events_between(
+                today, today + timedelta(days=7))
+            messages = self.generate_week_messages(events_by_title)
         else:
-            events = list(filter(
-                lambda e: e.start.astimezone(self.tz).date()
-                == self.now.date(), self.events))
-            messages = self.generate_day_messages(events)
+            events_by_title = self.index.events_on(today)
+            messages = self.generate_day_messages(events_by_title)
         return messages
 
-    def generate_day_messages(self, events: List[Event]) -> List[str]:
-        events_by_title = divide_events_by_title(events)
+    def window_events(self) -> List[Event]:
+        # generate_messages が扱う期間のイベント
+        today = self.now.date()
+        if self.week:
+            events_by_title = self.index.events_between(
+                today, today + timedelta(days=7))
+        else:
+            events_by_title = self.index.events_on(today)
+        return [e for events in events_by_title.values() for e in events]
+
+    def iter_range_messages(
+            self, since: date, until: date,
+            targets: Optional[List[Target]] = None,
+            indexes: Optional[Dict[tzinfo, EventIndex]] = None
+            ) -> Iterator[Tuple[date, List[Tuple[Target, List[str]]]]]:
+        # since から until の前日まで、1 日 (week なら 7 日) ごとにメッセージを作る
+        if targets is None:
+            targets = [Target(self.tz, self.locale)]
+        if indexes is None:
+            indexes = {}
+        if self._index is not None:
+            indexes.setdefault(self.tz, self._index)
+        days = 7 if self.week else 1
+        sweeps = []
+        for target in targets:
+            index = indexes.get(target.tz)
+            if index is None:
+                index = EventIndex(self.events, target.tz, self.categorizer)
+                indexes[target.tz] = index
+            mg = MessageGenerator(events=self.events, now=self.now,
+                                  week=self.week, locale=target.locale,
+                                  tz=target.tz, index=index,
+                                  categorizer=self.categorizer,
+                                  templates=self.catalog,
+                                  max_length=self.max_length)
+            sweeps.append((target, mg, index.iter_windows(since, until,
+                                                          days)))
+        while True:
+            results: List[Tuple[Target, List[str]]] = []
+            first: Optional[date] = None
+            for target, mg, windows in sweeps:
+                window = next(windows, None)
+                if window is None:
+                    return
+                first, events_by_title = window
+                if self.week:
+                    messages = mg.generate_week_messages(events_by_title)
+                else:
+                    messages = mg.generate_day_messages(events_by_title)
+                results.append((target, messages))
+            if first is None:
+                return
+            yield first, results
+
+    def generate_messages_for_targets(
+            self, targets: List[Target],
+            indexes: Optional[Dict[tzinfo, EventIndex]] = None
+            ) -> List[Tuple[Target, List[str]]]:
+        # 同じタイムゾーンのターゲットどうしでインデックスを共有する
+        if indexes is None:
+            indexes = {}
+        if self._index is not None:
+            indexes.setdefault(self.tz, self._index)
+        results: List[Tuple[Target, List[str]]] = []
+        for target in targets:
+            index = indexes.get(target.tz)
+            if index is None:
+                index = EventIndex(self.events, target.tz, self.categorizer)
+                indexes[target.tz] = index
+            mg = MessageGenerator(events=self.events, now=self.now,
+                                  week=self.week, locale=target.locale,
+                                  tz=target.tz, index=index,
+                                  categorizer=self.categorizer,
+                                  templates=self.catalog,
+                                  max_length=self.max_length)
+            results.append((target, mg.generate_messages()))
+        return results
+
+    def generate_day_messages(
+            self, events_by_title: Dict[str, List[Event]]) -> List[str]:
+        t = self.templates
         messages: List[str] = []
 
         # 開館
@@ -98,8 +931,8 @@ class MessageGenerator:
             open_event = open_events[0]
             open_start = open_event.get_start(self.tz)
             open_end = open_event.get_end(self.tz)
-            open_message = "本日の CAMPHOR- HOUSE の開館時間は"\
-                f"{open_start}〜{open_end}です。\n"
+            body: List[str] = []
+            t["day_open"].render_into(body, start=open_start, end=open_end)
             # CAMPHOR- Make あり
             make_events = events_by_title["make"]
             if len(make_events) == 1:
@@ -108,17 +941,17 @@ class MessageGenerator:
                 make_end = make_event.get_end(self.tz)
                 # 時間同じ
                 if open_start == make_start and open_end == make_end:
-                    open_message += "CAMPHOR- Make も利用できます。\n"
+                    t["day_make_same"].render_into(body)
                 # 時間異なる
                 else:
-                    open_message += "CAMPHOR- Make は"\
-                        f"{make_start}〜{make_end}に利用できます。\n"
+                    t["day_make"].render_into(body, start=make_start,
+                                              end=make_end)
             elif len(make_events) > 1:
                 raise ValueError("The maximum number of Make events per day"
                                  " is one, but found several.")
-            open_message += "みなさんのお越しをお待ちしています!!\n"
-            open_message += "HOUSEの場所はこちら\nhttps://goo.gl/maps/qasTRtgjnoP2"
-            messages.append(self.add_schedule_link(open_message))
+            t["day_open_footer"].render_into(body)
+            messages += self.compose([], ["".join(body)],
+                                     self.schedule_link_parts())
         elif len(open_events) > 1:
             raise ValueError("The maximum number of Open events per day is"
                              " one, but found several.")
@@ -127,13 +960,12 @@ class MessageGenerator:
         online_open_events = events_by_title["online open"]
         if len(online_open_events) == 1:
             online_open_event = online_open_events[0]
-            start = online_open_event.get_start(self.tz)
-            end = online_open_event.get_end(self.tz)
-            online_open_message = textwrap.dedent(f"""\
-                本日の CAMPHOR- HOUSE のオンライン開館時間は{start}〜{end}です。
-                詳しくはCAMPHOR-のSlackをご覧ください!!
-                """)
-            messages.append(self.add_schedule_link(online_open_message))
+            body = []
+            t["day_online_open"].render_into(
+                body, start=online_open_event.get_start(self.tz),
+                end=online_open_event.get_end(self.tz))
+            messages += self.compose([], ["".join(body)],
+                                     self.schedule_link_parts())
         elif len(online_open_events) > 1:
             raise ValueError("The maximum number of Online Open events per"
                              " day is one, but found several.")
@@ -142,84 +974,163 @@ class MessageGenerator:
         other_events = events_by_title["other"]
         if len(other_events) == 1:
             other_event = other_events[0]
-            start = other_event.get_start(self.tz)
-            end = other_event.get_end(self.tz)
+            body = []
+            t["day_other"].render_into(
+                body, title=other_event.title,
+                start=other_event.get_start(self.tz),
+                end=other_event.get_end(self.tz))
             url = other_event.url
-            other_message = textwrap.dedent(f"""\
-                「{other_event.title}」を{start}〜{end}に開催します!
-                みなさんのお越しをお待ちしています!!""")
-            if url is not None and url != "":
-                other_message += f"\n{url}"
-            messages.append(other_message)
+            footer = [] if url is None or url == "" else ["\n", url]
+            messages += self.compose([], ["".join(body)], footer)
         elif len(other_events) > 1:
             raise ValueError("The maximum number of Other events per day"
                              " is one, but found several.")
 
         return messages
 
-    def generate_week_messages(self, events: List[Event]) -> List[str]:
-        events_by_title = divide_events_by_title(events)
+    def generate_week_messages(
+            self, events_by_title: Dict[str, List[Event]]) -> List[str]:
+        t = self.templates
         messages: List[str] = []
 
         # 開館日
         open_events = events_by_title["open"]
         if len(open_events) != 0:
-            open_message = "今週の開館日です！\n"
             # CAMPHOR- Make が利用可能なとき、日時の後に`(Make)`を付ける
+            make_dates = {e.start.date() for e in events_by_title["make"]}
+            make_mark = t["week_make_mark"].render()
+            lines = []
             for event in open_events:
-                open_message += event.get_day_and_time(self.tz)
-                if event.start.date() in [e.start.date()
-                                          for e in events_by_title["make"]]:
-                    open_message += " (Make)"
-                open_message += "\n"
-            open_message += "\nみなさんのお越しをお待ちしています!!\n"
-            messages.append(self.add_schedule_link(open_message))
+                line = self.get_day_and_time(event)
+                if event.start.date() in make_dates:
+                    line += make_mark
+                lines.append(line + "\n")
+            footer: List[str] = []
+            t["week_open_footer"].render_into(footer)
+            messages += self.compose(
+                [t["week_open_header"].render()], lines,
+                footer + self.schedule_link_parts())
 
         # オンライン開館日
         online_open_events = events_by_title["online open"]
         if len(online_open_events) != 0:
-            online_open_message = "今週のオンライン開館日です！\n"
-            for event in online_open_events:
-                online_open_message += event.get_day_and_time(self.tz) + "\n"
-            online_open_message += "\n詳しくはCAMPHOR-のSlackをご覧ください!!\n"
-            messages.append(self.add_schedule_link(online_open_message))
+            lines = [self.get_day_and_time(event) + "\n"
+                     for event in online_open_events]
+            footer = []
+            t["week_online_open_footer"].render_into(footer)
+            messages += self.compose(
+                [t["week_online_open_header"].render()], lines,
+                footer + self.schedule_link_parts())
 
         # その他のイベント日
         other_events = events_by_title["other"]
         if len(other_events) != 0:
-            other_message = "今週のイベント情報です！\n"
+            lines = []
             for event in other_events:
-                other_message += event.get_day_and_time_with_title(
-                    self.tz) + "\n"
+                line = f"{event.title} {self.get_day_and_time(event)}\n"
                 if event.url is not None:
-                    other_message += f"{event.url}\n"
-            other_message += "\nお申し込みの上ご参加ください。\nみなさんのお越しをお待ちしています!!"
-            messages.append(other_message)
+                    line += f"{event.url}\n"
+                lines.append(line)
+            messages += self.compose(
+                [t["week_other_header"].render()], lines,
+                [t["week_other_footer"].render()])
 
         return messages
 
+    def generate_reminder_message(self, event: Event,
+                                  before: timedelta) -> str:
+        minutes = int(before.total_seconds()) // 60
+        return self.templates["reminder"].render(
+            title=event.title, minutes=minutes,
+            start=event.get_start(self.tz), end=event.get_end(self.tz))
+
+    def get_day_and_time(self, event: Event) -> str:
+        if self.catalog is DEFAULT_TEMPLATES:
+            return event.get_day_and_time(self.tz, self.locale)
+        localized = event.localize(self.tz)
+        weekday = WEEKDAY_NAMES_BY_LOCALE[self.locale][
+            localized.start.weekday()]
+        return self.templates["day_and_time"].render(
+            date=localized.start.strftime("%m/%d"), weekday=weekday,
+            start=localized.start_time, end=localized.end_time)
+
     def add_schedule_link(self, message: str) -> str:
-        message += f"\nその他の開館日はこちら\n{SCHEDULE_LINK}"
-        return message
+        return "".join([message] + self.schedule_link_parts())
+
+    def schedule_link_parts(self) -> List[str]:
+        parts: List[str] = []
+        self.templates["schedule_link"].render_into(parts, link=SCHEDULE_LINK)
+        return parts
+
+    def compose(self, header: List[str], items: List[str],
+                footer: List[str]) -> List[str]:
+        # 長さの上限を超える場合は、項目の区切りで複数のメッセージに分ける
+        if self.max_length is None:
+            return ["".join(header + items + footer)]
+        fixed = sum(tweet_length(p) for p in header) \
+            + sum(tweet_length(p) for p in footer)
+        budget = self.max_length - fixed
+        if budget <= 0:
+            return split_text("".join(header + items + footer),
+                              self.max_length)
+        pages: List[List[str]] = [[]]
+        length = 0
+        for item in items:
+            item_length = tweet_length(item)
+            if item_length > budget:
+                for chunk in split_text(item, budget):
+                    pages.append([chunk])
+                pages.append([])
+                length = 0
+                continue
+            if pages[-1] and length + item_length > budget:
+                pages.append([])
+                length = 0
+            pages[-1].append(item)
+            length += item_length
+        return ["".join(header + page + footer) for page in pages if page]
+
+
+def parse_datetime(value: str) -> datetime:
+    # カレンダーが出力する YYYY-MM-DDTHH:MM:SS+HH:MM の形式だけを高速に処理する
+    m = _ISO_DATETIME_RE.match(value)
+    if m is None:
+        import dateutil.parser
+        return dateutil.parser.parse(value)
+    year, month, day, hour, minute, second, utc, sign, oh, om = m.groups()
+    offset = 0
+    if utc is None:
+        offset = int(oh) * 3600 + int(om) * 60
+        if sign == "-":
+            offset = -offset
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), tzinfo=get_fixed_timezone(offset))
+
+
+def get_fixed_timezone(offset: int) -> tzinfo:
+    tz = _FIXED_TIMEZONES.get(offset)
+    if tz is None:
+        tz = timezone(timedelta(seconds=offset))
+        _FIXED_TIMEZONES[offset] = tz
+    return tz
 
 
 def get_japanese_weekday(day: int) -> str:
     return WEEKDAY_NAMES[day]
 
 
+def categorize_title(title: str) -> Optional[str]:
+    return DEFAULT_CATEGORIZER.categorize(title)
+
+
 def divide_events_by_title(events: List[Event]) -> Dict[str, List[Event]]:
-    events_by_title: Dict[str, List[Event]] = {}
-    for title in ["open", "make", "online open"]:
-        events_by_title[title] = [
-            e for e in events if e.title.lower() == title]
-        events = [e for e in events if e.title.lower() != title]
-    events_by_title["other"] = [e for e in events if e.title.strip() != ""]
-    return events_by_title
+    return DEFAULT_CATEGORIZER.divide(events)
 
 
 def validate_datetime(ctx, param, value) -> Optional[datetime]:
     if value is None:
         return None
+    import dateutil.parser
     try:
         dt = dateutil.parser.parse(value)
     except ValueError:
@@ -227,9 +1138,73 @@ def validate_datetime(ctx, param, value) -> Optional[datetime]:
     return dt  # WARNING: tzinfo might be None
 
 
-@click.command(help="CAMPHOR- Schedule Notifier")
-@click.option("--url", default="https://cal.camph.net/public/schedule.json",
-              envvar="CSN_URL", help="URL of a schedule file.")
+def validate_targets(ctx, param, value) -> List[Target]:
+    import pytz
+    targets = []
+    for v in value:
+        name, _, locale = v.partition(":")
+        try:
+            tz = pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            ctx.fail(f"Unknown time zone '{name}'")
+        locale = locale or ctx.params.get("locale") or "ja"
+        if locale not in MESSAGES:
+            ctx.fail(f"Unknown locale '{locale}'")
+        targets.append(Target(tz, locale))
+    return targets
+
+
+def validate_feeds(ctx, param, value) -> Optional[List[Feed]]:
+    if value is None:
+        return None
+    try:
+        feeds = load_feeds(value)
+    except (OSError, TypeError, ValueError) as e:
+        ctx.fail(f"Invalid feeds '{value}': {e}")
+    return feeds
+
+
+def validate_sinks(ctx, param, value) -> List[Tuple[str, Optional[str]]]:
+    sinks: List[Tuple[str, Optional[str]]] = []
+    for v in value:
+        kind, _, url = v.partition(":")
+        if kind not in SINKS:
+            ctx.fail(f"Unknown sink '{kind}'")
+        if kind != "twitter" and url == "":
+            ctx.fail(f"Sink '{kind}' needs a URL, e.g. '{kind}:https://...'")
+        if kind == "twitter" and ("twitter", None) in sinks:
+            ctx.fail("Sink 'twitter' can be given only once")
+        sinks.append((kind, url or None))
+    return sinks
+
+
+def validate_templates(ctx, param, value
+                       ) -> Optional[Dict[str, Dict[str, MessageTemplate]]]:
+    if value is None:
+        return None
+    try:
+        templates = load_templates(value)
+    except (OSError, ValueError) as e:
+        ctx.fail(f"Invalid templates '{value}': {e}")
+    return templates
+
+
+@click.group(help="CAMPHOR- Schedule Notifier",
+             invoke_without_command=True)
+@click.option("--url", "urls", multiple=True,
+              default=["https://cal.camph.net/public/schedule.json"],
+              envvar="CSN_URL",
+              help="URL of a schedule file. Can be given several times to"
+              " merge several schedules.")
+@click.option("--feeds", "feed_list", type=click.Path(dir_okay=False),
+              callback=validate_feeds, envvar="CSN_FEEDS",
+              help="JSON list of schedule files to merge, each a URL or an"
+              " object with 'url', 'timeout' and 'required'. Overrides"
+              " --url.")
+@click.option("--feed-timeout", default=30.0, type=click.FLOAT,
+              envvar="CSN_FEED_TIMEOUT",
+              help="Seconds to wait for a schedule file given with --url."
+              " (default: 30)")
 @click.option("--api-key", type=click.STRING,
               envvar="CSN_API_KEY", help="Twitter API Key.")
 @click.option("--api-secret", type=click.STRING,
@@ -243,44 +1218,2259 @@ def validate_datetime(ctx, param, value) -> Optional[datetime]:
               help="Write messages to stdout.")
 @click.option("--timezone", default="Asia/Tokyo",
               help="Time zone used to show time. (default: Asia/Tokyo)")
+@click.option("--locale", default="ja", type=click.Choice(sorted(MESSAGES)),
+              is_eager=True, envvar="CSN_LOCALE",
+              help="Language of messages. (default: ja)")
+@click.option("--target", "targets", multiple=True, callback=validate_targets,
+              metavar="TIMEZONE[:LOCALE]",
+              help="Render messages for this time zone and language."
+              " Can be given several times to render them all at once."
+              " (default: --timezone and --locale)")
+@click.option("--templates", type=click.Path(dir_okay=False),
+              callback=validate_templates, envvar="CSN_TEMPLATES",
+              help="JSON file of message templates keyed by locale, which"
+              " overrides the built-in wording.")
 @click.option("--now", callback=validate_datetime,
               help="Specify current time for debugging. (example: 2017-01-01)")
 @click.option("--week", default=False, is_flag=True,
               envvar="CSN_WEEK", help="Notify weekly schedule.")
-def main(url: str, api_key: str, api_secret: str, access_token: str,
-         access_token_secret: str, dry_run: bool, timezone: str,
-         now: datetime, week: bool) -> None:
+@click.option("--from", "range_from", callback=validate_datetime,
+              help="Notify every day (or every 7 days with --week) from this"
+              " date to --to, e.g. to preview a month. (example: 2017-01-01)")
+@click.option("--to", "range_to", callback=validate_datetime,
+              help="Last day notified with --from. (example: 2017-01-31)")
+@click.option("--sink", "sinks", multiple=True, callback=validate_sinks,
+              metavar="KIND[:URL]",
+              help="Where to post messages: 'twitter', 'slack:WEBHOOK_URL',"
+              " 'mastodon:SERVER_URL' or 'webhook:URL'. Can be given several"
+              " times to post to all of them at once. (default: twitter)")
+@click.option("--mastodon-token", type=click.STRING,
+              envvar="CSN_MASTODON_TOKEN", help="Mastodon access token.")
+@click.option("--post-concurrency", default=1, type=click.IntRange(1, None),
+              envvar="CSN_POST_CONCURRENCY",
+              help="Number of messages posted at the same time. (default: 1)")
+@click.option("--post-retries", default=3, type=click.IntRange(0, None),
+              envvar="CSN_POST_RETRIES",
+              help="Number of retries for a failed post. (default: 3)")
+@click.option("--post-timeout", default=30.0, type=click.FLOAT,
+              envvar="CSN_POST_TIMEOUT",
+              help="Seconds to wait for a response to a post. A post that"
+              " timed out is not retried, as it may have been posted."
+              " (default: 30)")
+@click.option("--post-record", type=click.Path(dir_okay=False),
+              envvar="CSN_POST_RECORD",
+              help="File to record posted messages in, so that a retried"
+              " run does not post them twice.")
+@click.option("--metrics-file", type=click.Path(dir_okay=False),
+              envvar="CSN_METRICS_FILE",
+              help="Write timings and counts of each stage to this file,"
+              " in the Prometheus textfile format if it ends with .prom"
+              " and in JSON otherwise.")
+@click.option("--profile", "profile_file", type=click.Path(dir_okay=False),
+              help="Profile the run with cProfile and dump the stats to"
+              " this file.")
+@click.option("--store", "store_path", type=click.Path(dir_okay=False),
+              envvar="CSN_STORE",
+              help="SQLite database to keep events in. Only changes of the"
+              " schedule file are written, and announced events are"
+              " recorded. Takes precedence over --cache-dir.")
+@click.option("--cache-dir", type=click.Path(file_okay=False),
+              envvar="CSN_CACHE_DIR",
+              help="Directory to cache the schedule file in.")
+@click.option("--cache-ttl", default=7 * 24 * 60 * 60, type=click.INT,
+              envvar="CSN_CACHE_TTL",
+              help="Seconds to keep an unused cache entry. (default: 7 days)")
+@click.option("--cache-max-size", default=64 * 1024 * 1024, type=click.INT,
+              envvar="CSN_CACHE_MAX_SIZE",
+              help="Maximum size of the cache in bytes. (default: 64 MiB)")
+@click.option("--json-backend", default="auto",
+              type=click.Choice(["auto"] + JSON_BACKENDS),
+              envvar="CSN_JSON_BACKEND",
+              help="Decoder of the schedule file. 'auto' uses orjson or"
+              " msgspec when installed. (default: auto)")
+@click.option("--render-cache-size", default=128, type=click.IntRange(0, None),
+              envvar="CSN_RENDER_CACHE_SIZE",
+              help="Number of rendered message sets kept in --cache-dir, so"
+              " that a rerun for the same schedule does not render again."
+              " 0 disables it. (default: 128)")
+@click.option("--ledger", "ledger_path", type=click.Path(dir_okay=False),
+              envvar="CSN_LEDGER",
+              help="File recording the days and weeks already announced."
+              " An announced day or week is skipped without downloading"
+              " the schedule file.")
+@click.option("--update", default=False, is_flag=True,
+              help="Post the messages that changed since the day or week was"
+              " announced, as recorded in --ledger.")
+@click.option("--force", default=False, is_flag=True,
+              help="Post every message even if the day or week was"
+              " announced, as recorded in --ledger.")
+@click.option("--columnar", default=False, is_flag=True,
+              envvar="CSN_COLUMNAR",
+              help="Select the events of each day of --from/--to with numpy"
+              " arrays. Needs numpy.")
+@click.pass_context
+def main(ctx: click.Context, urls: Tuple[str, ...],
+         feed_list: Optional[List[Feed]], feed_timeout: float,
+         api_key: str, api_secret: str, access_token: str,
+         access_token_secret: str, dry_run: bool, timezone: str, locale: str,
+         targets: List[Target],
+         templates: Optional[Dict[str, Dict[str, MessageTemplate]]],
+         now: datetime, week: bool, range_from: Optional[datetime],
+         range_to: Optional[datetime],
+         sinks: List[Tuple[str, Optional[str]]],
+         mastodon_token: Optional[str], post_concurrency: int,
+         post_retries: int, post_timeout: float,
+         post_record: Optional[str],
+         metrics_file: Optional[str],
+         profile_file: Optional[str], store_path: Optional[str],
+         cache_dir: Optional[str], cache_ttl: int, cache_max_size: int,
+         json_backend: str, render_cache_size: int,
+         ledger_path: Optional[str], update: bool, force: bool,
+         columnar: bool) -> None:
+    if profile_file is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump_profile() -> None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        ctx.call_on_close(dump_profile)
+
+    import pytz
     tz = pytz.timezone(timezone)
+    cache = None
+    if cache_dir is not None:
+        cache = FeedCache(cache_dir, ttl=timedelta(seconds=cache_ttl),
+                          max_bytes=cache_max_size)
+    render_cache = None
+    if cache_dir is not None and render_cache_size > 0:
+        render_cache = RenderCache(os.path.join(cache_dir, "render"),
+                                   ttl=timedelta(seconds=cache_ttl),
+                                   max_entries=render_cache_size)
+    store = None
+    if store_path is not None:
+        store = EventStore(store_path)
+        ctx.call_on_close(store.close)
+    if update and force:
+        raise click.UsageError("--update and --force cannot be used together")
+    ledger = None
+    if ledger_path is not None:
+        ledger = AnnouncementLedger(ledger_path)
+    repost = "all" if force else "changed" if update else "never"
+    try:
+        # auto は取得のたびに、フィード全体を読むかどうかで選ぶ
+        if json_backend != "auto":
+            json_backend = resolve_json_backend(json_backend)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--json-backend")
+    if columnar and range_from is None:
+        raise click.BadParameter("it applies only with --from and --to",
+                                 param_hint="--columnar")
+    if columnar:
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            raise click.BadParameter("numpy is not installed",
+                                     param_hint="--columnar")
+    feeds = feed_list
+    if feeds is None:
+        feeds = [Feed(url, timeout=feed_timeout) for url in urls]
+    notifier = Notifier(
+        feeds=feeds, credentials=(api_key, api_secret, access_token,
+                                  access_token_secret),
+        tz=tz, locale=locale, targets=targets, templates=templates,
+        dry_run=dry_run, cache=cache, store=store, render_cache=render_cache,
+        ledger=ledger, repost=repost, json_backend=json_backend,
+        columnar=columnar,
+        post_concurrency=post_concurrency, post_retries=post_retries,
+        post_timeout=post_timeout, post_record=post_record, sinks=sinks,
+        mastodon_token=mastodon_token, metrics_file=metrics_file)
+    ctx.obj = notifier
+    ctx.call_on_close(notifier.write_metrics)
+    if ctx.invoked_subcommand is not None:
+        return
+
     if now is None:
         now = datetime.now(tz=tz)
     elif now.tzinfo is None:
         now = now.replace(tzinfo=tz)
+    if (range_from is None) != (range_to is None):
+        raise click.UsageError("--from and --to must be given together")
+    if range_from is not None and range_to is not None \
+            and range_to < range_from:
+        raise click.UsageError("--to must not be before --from")
+    if range_from is not None and not dry_run:
+        # 別の日付の「本日の…」をまとめて投稿しないよう、確認用に限る
+        raise click.UsageError("--from and --to need --dry-run")
+    with notifier.metrics.timer("total"):
+        if range_from is not None and range_to is not None:
+            notifier.notify_range(range_from.date(),
+                                  range_to.date() + timedelta(days=1),
+                                  week, now)
+        else:
+            notifier.notify(now, week)
 
-    events = download_events(url)
+
+@main.command(help="Stay resident and notify on an internal schedule.")
+@click.option("--daily", "daily_cron", default="0 8 * * *",
+              metavar="CRON",
+              help="When to notify the daily schedule, in --timezone."
+              " (default: '0 8 * * *')")
+@click.option("--weekly", "weekly_cron", default="0 8 * * 1",
+              metavar="CRON",
+              help="When to notify the weekly schedule, in --timezone."
+              " (default: '0 8 * * 1')")
+@click.option("--refresh-interval", default=600, type=click.IntRange(1, None),
+              help="Seconds between downloads of the schedule file."
+              " (default: 600)")
+@click.option("--remind-before", default=0, type=click.IntRange(0, None),
+              help="Notify this many minutes before each event starts."
+              " (default: 0, disabled)")
+@click.pass_obj
+def serve(notifier: "Notifier", daily_cron: str, weekly_cron: str,
+          refresh_interval: int, remind_before: int) -> None:
+    try:
+        daily = CronSchedule(daily_cron, notifier.tz)
+        weekly = CronSchedule(weekly_cron, notifier.tz)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    daemon = Daemon(notifier, daily=daily, weekly=weekly,
+                    refresh_interval=refresh_interval,
+                    remind_before=timedelta(minutes=remind_before))
+    daemon.run()
+
+
+@main.command(help="Convert the schedule file into a snapshot of parsed"
+              " events, which can be loaded without parsing.")
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option("--input", "input_file", type=click.File("rb"),
+              help="Read the schedule file from this file ('-' for stdin)"
+              " instead of downloading it.")
+@click.pass_obj
+def snapshot(notifier: "Notifier", output: str,
+             input_file: Optional[BinaryIO]) -> None:
+    if input_file is not None:
+        chunks = iter(lambda: input_file.read(FEED_CHUNK_SIZE), b"")
+        json_backend = notifier.json_backend
+        if json_backend == "auto":
+            json_backend = resolve_json_backend(json_backend)
+        events: Optional[List[Event]] = list(iter_events(
+            chunks, metrics=notifier.metrics, json_backend=json_backend))
+    else:
+        events = download_feeds(notifier.feeds, metrics=notifier.metrics,
+                                session=notifier.session,
+                                json_backend=notifier.json_backend)
     if events is None:
-        return
-    mg = MessageGenerator(events=events, now=now, week=week)
-    messages = mg.generate_messages()
-    if dry_run:
-        for i, message in enumerate(messages):
-            print(f"#{i + 1}\n{message}")
-        return
-    if len(messages) > 0:
-        twitter_client = OAuth1Session(api_key,
-                                       api_secret,
-                                       access_token,
-                                       access_token_secret)
-        endpoint = "https://api.twitter.com/2/tweets"
+        raise click.ClickException("Failed to download the schedule file")
+    table = EventTable.from_events(events)
+    write_snapshot(output, table)
+    click.echo(f"Wrote {len(table)} events to {output}", err=True)
+
+
+@main.command("http", help="Serve rendered messages and events over HTTP"
+              " from one in-memory copy of the schedule.")
+@click.option("--host", default="127.0.0.1",
+              help="Address to listen on. (default: 127.0.0.1)")
+@click.option("--port", default=8080, type=click.IntRange(0, 65535),
+              help="Port to listen on. (default: 8080)")
+@click.option("--refresh-interval", default=600, type=click.IntRange(1, None),
+              help="Seconds between downloads of the schedule file."
+              " (default: 600)")
+@click.pass_obj
+def serve_http(notifier: "Notifier", host: str, port: int,
+               refresh_interval: int) -> None:
+    server = ScheduleServer(notifier, refresh_interval=refresh_interval)
+    server.run(host, port)
+
+
+class Metrics:
+    durations: Dict[str, float]
+    counts: Dict[str, int]
+    observations: Dict[str, List[float]]
+
+    def __init__(self) -> None:
+        self.durations = {}
+        self.counts = {}
+        self.observations = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(stage, time.perf_counter() - begin)
+
+    def add_duration(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self.observations.setdefault(name, []).append(value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"durations": dict(self.durations),
+                    "counts": dict(self.counts),
+                    "observations": {k: list(v) for k, v
+                                     in self.observations.items()}}
+
+    def to_prometheus(self) -> str:
+        data = self.to_dict()
+        lines = ["# TYPE schedule_notifier_stage_seconds gauge"]
+        for stage, seconds in sorted(data["durations"].items()):
+            lines.append(f'schedule_notifier_stage_seconds{{stage="{stage}"}}'
+                         f" {seconds:.6f}")
+        for name, n in sorted(data["counts"].items()):
+            name = _prometheus_name(name)
+            lines.append(f"# TYPE schedule_notifier_{name} gauge")
+            lines.append(f"schedule_notifier_{name} {n}")
+        for name, values in sorted(data["observations"].items()):
+            name = _prometheus_name(name)
+            lines.append(f"# TYPE schedule_notifier_{name} summary")
+            lines.append(f"schedule_notifier_{name}_count {len(values)}")
+            lines.append(f"schedule_notifier_{name}_sum {sum(values):.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        # 拡張子が .prom なら node_exporter の textfile 形式で書き出す
+        if path.endswith(".prom"):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.to_dict(), indent=2) + "\n"
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def _prometheus_name(name: str) -> str:
+    # 送り先の名前 ("webhook-2" など) はメトリクス名に使えない文字を含みうる
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+
+def download_events(url: str, since: Optional[date] = None,
+                    until: Optional[date] = None,
+                    cache: Optional["FeedCache"] = None,
+                    metrics: Optional[Metrics] = None,
+                    store: Optional["EventStore"] = None,
+                    session: Optional["requests.Session"] = None,
+                    timeout: Optional[float] = None,
+                    json_backend: str = "stdlib"
+                    ) -> Optional[List[Event]]:
+    import requests
+    metrics = metrics if metrics is not None else Metrics()
+    get = session.get if session is not None else requests.get
+    if json_backend == "auto" and (store is not None or cache is not None
+                                   or since is None and until is None):
+        # フィード全体を持つときだけ速いデコーダでまとめてデコードする。
+        # 期間で絞るときはストリーミングのまま、メモリを一定に保つ
+        json_backend = resolve_json_backend("auto")
+    if store is not None:
+        # ストアがあればキャッシュより優先する
+        headers = store.request_headers(url)
+    elif cache is not None:
+        headers = cache.request_headers(url)
+    else:
+        headers = {}
+    with metrics.timer("fetch"):
+        response = get(url, headers=headers, stream=True, timeout=timeout)
+    with response:
+        if response.status_code == requests.codes.not_modified \
+                and store is not None:
+            # 変更がなければストアの内容をそのまま使う
+            pass
+        elif response.status_code == requests.codes.not_modified \
+                and cache is not None:
+            with metrics.timer("cache_load"):
+                snapshot = cache.load_events(url)
+            if snapshot is None:
+                # キャッシュが壊れていたら取り直す
+                cache.invalidate(url)
+                return download_events(url, since, until, cache, metrics,
+                                       session=session, timeout=timeout,
+                                       json_backend=json_backend)
+            cache.touch(url)
+            with snapshot:
+                events = snapshot.select(_utc_midnight(since),
+                                         _utc_midnight(until))
+            metrics.count("events_in_window", len(events))
+            return events
+        elif response.status_code != requests.codes.ok:
+            return None
+        else:
+            chunks = response.iter_content(chunk_size=FEED_CHUNK_SIZE)
+            if store is not None:
+                # 差分を取るためにフィード全体を読む
+                added, updated, removed = store.sync(
+                    url, iter_events(chunks, metrics=metrics,
+                                     json_backend=json_backend),
+                    response.headers, metrics=metrics)
+                metrics.count("events_added", added)
+                metrics.count("events_updated", updated)
+                metrics.count("events_removed", removed)
+            elif cache is None:
+                events = list(iter_events(chunks, since=since, until=until,
+                                          metrics=metrics,
+                                          json_backend=json_backend))
+                metrics.count("events_in_window", len(events))
+                return events
+            else:
+                table = cache.fill(url, response.headers, chunks, metrics,
+                                   json_backend)
+    if store is not None:
+        with metrics.timer("store_query"):
+            events = store.select(_utc_midnight(since), _utc_midnight(until),
+                                  url=url)
+    else:
+        events = table.select(_utc_midnight(since), _utc_midnight(until))
+    metrics.count("events_in_window", len(events))
+    return events
 
-        for message in messages:
-            twitter_client.post(endpoint, json={"text": message})
 
+def download_feeds(feeds: List[Feed], since: Optional[date] = None,
+                   until: Optional[date] = None,
+                   cache: Optional["FeedCache"] = None,
+                   metrics: Optional[Metrics] = None,
+                   store: Optional["EventStore"] = None,
+                   session: Optional["requests.Session"] = None,
+                   json_backend: str = "stdlib"
+                   ) -> Optional[List[Event]]:
+    import concurrent.futures
+    import requests
+    metrics = metrics if metrics is not None else Metrics()
+    if len(feeds) == 1:
+        feed = feeds[0]
+        return _download_feed(feed, since, until, cache, metrics, store,
+                              session, json_backend)
+    if session is None:
+        session = feed_session(len(feeds))
+    # 全フィードを同時に取得するので、待ち時間は最も遅いフィードの分で済む
+    with concurrent.futures.ThreadPoolExecutor(len(feeds)) as pool:
+        futures = [pool.submit(_download_feed, feed, since, until, cache,
+                               metrics, store, session, json_backend)
+                   for feed in feeds]
+    results = []
+    for feed, future in zip(feeds, futures):
+        try:
+            events = future.result()
+        except (requests.RequestException, ValueError) as e:
+            if feed.required:
+                raise
+            click.echo(f"schedule-notifier: {feed.url}: {e}", err=True)
+            events = None
+        if events is None:
+            metrics.count("feed_failures")
+            if feed.required:
+                return None
+            continue
+        results.append(sorted(events, key=lambda e: e.start))
+    return merge_events(results)
 
-def download_events(url: str) -> Optional[List[Event]]:
-    response = requests.get(url)
-    if response.status_code != requests.codes.ok:
+
+def _download_feed(feed: Feed, since: Optional[date], until: Optional[date],
+                   cache: Optional["FeedCache"], metrics: Metrics,
+                   store: Optional["EventStore"],
+                   session: Optional["requests.Session"], json_backend: str
+                   ) -> Optional[List[Event]]:
+    return download_events(feed.url, since=since, until=until, cache=cache,
+                           metrics=metrics, store=store, session=session,
+                           timeout=feed.timeout, json_backend=json_backend)
+
+
+def feed_session(pool_size: int) -> "requests.Session":
+    import requests
+    import requests.adapters
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def merge_events(sorted_events: Iterable[Iterable[Event]]) -> List[Event]:
+    # 開始時刻順に並んだ列を一度でまとめ、開始時刻とタイトルが同じものは一つにする
+    merged: List[Event] = []
+    current: Optional[datetime] = None
+    titles: Set[str] = set()
+    for event in heapq.merge(*sorted_events, key=lambda e: e.start):
+        if event.start != current:
+            current = event.start
+            titles.clear()
+        elif event.title in titles:
+            continue
+        titles.add(event.title)
+        merged.append(event)
+    return merged
+
+
+def load_feeds(path: str) -> List[Feed]:
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or len(entries) == 0:
+        raise ValueError("Feeds must be a non-empty list")
+    feeds = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        if not isinstance(entry, dict) or \
+                not isinstance(entry.get("url"), str):
+            raise ValueError(f"Invalid feed '{entry}'")
+        unknown = entry.keys() - Feed._fields
+        if unknown:
+            raise ValueError(f"Unknown keys in feed '{entry['url']}': "
+                             + ", ".join(sorted(unknown)))
+        feeds.append(Feed(**entry))
+    return feeds
+
+
+def _utc_midnight(day: Optional[date]) -> Optional[datetime]:
+    if day is None:
         return None
-    return [Event.from_json(e) for e in response.json()]
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def iter_events(chunks: Iterable[bytes], since: Optional[date] = None,
+                until: Optional[date] = None,
+                metrics: Optional[Metrics] = None,
+                json_backend: str = "stdlib") -> Iterator[Event]:
+    metrics = metrics if metrics is not None else Metrics()
+    # [since, until) の範囲外のイベントは日時をパースする前に捨てる
+    lower = since.isoformat() if since is not None else None
+    upper = until.isoformat() if until is not None else None
+    clock = time.perf_counter
+    fetch = [0.0]
+    items = iter_feed_items(_timed_chunks(chunks, metrics, fetch),
+                            json_backend)
+    decode = parse = 0.0
+    try:
+        while True:
+            # 受信を待っていた時間はデコードの時間から除く
+            begin = clock()
+            fetched = fetch[0]
+            data: Any = next(items, _END)
+            decode += clock() - begin - (fetch[0] - fetched)
+            if data is _END:
+                break
+            metrics.count("feed_items")
+            start = data.get("start")
+            if isinstance(start, str) and _DATE_PREFIX_RE.match(start):
+                if lower is not None and start[:10] < lower or \
+                        upper is not None and start[:10] >= upper:
+                    metrics.count("events_filtered")
+                    continue
+            begin = clock()
+            event = Event.from_json(data)
+            parse += clock() - begin
+            yield event
+    finally:
+        metrics.add_duration("decode", decode)
+        metrics.add_duration("parse", parse)
+
+
+def _timed_chunks(chunks: Iterable[bytes], metrics: Metrics,
+                  fetch: List[float]) -> Iterator[bytes]:
+    it = iter(chunks)
+    while True:
+        begin = time.perf_counter()
+        chunk = next(it, None)
+        elapsed = time.perf_counter() - begin
+        fetch[0] += elapsed
+        metrics.add_duration("fetch", elapsed)
+        if chunk is None:
+            return
+        metrics.count("feed_bytes", len(chunk))
+        yield chunk
+
+
+def resolve_json_backend(name: str) -> str:
+    import importlib
+    candidates = JSON_BACKENDS if name == "auto" else [name]
+    for candidate in candidates:
+        if candidate not in JSON_BACKENDS:
+            raise ValueError(f"Unknown JSON backend '{candidate}'")
+        if candidate == "stdlib":
+            return candidate
+        try:
+            importlib.import_module(candidate)
+        except ImportError:
+            continue
+        return candidate
+    raise ValueError(f"JSON backend '{name}' is not installed")
+
+
+def iter_feed_items(chunks: Iterable[bytes],
+                    json_backend: str = "stdlib") -> Iterator[Any]:
+    # stdlib 以外はフィード全体を読んでから一度にデコードする。
+    # auto は呼び出し側で選ばれなかったので、ストリーミングのまま
+    if json_backend in ("stdlib", "auto"):
+        return iter_json_array(chunks)
+    body = b"".join(chunks)
+    if json_backend == "orjson":
+        import orjson
+        items = orjson.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("Schedule feed must be a JSON array")
+        return iter(items)
+    if json_backend == "msgspec":
+        import msgspec
+        try:
+            structs = msgspec.json.decode(body, type=_feed_items_type())
+        except msgspec.ValidationError as e:
+            raise ValueError(f"Invalid schedule feed: {e}")
+        return iter(structs)
+    raise ValueError(f"Unknown JSON backend '{json_backend}'")
+
+
+_FEED_ITEMS_TYPE: Any = None
+
+
+def _feed_items_type() -> Any:
+    # Event.from_json が使うフィールドだけを持つ構造体の列にデコードする
+    global _FEED_ITEMS_TYPE
+    if _FEED_ITEMS_TYPE is None:
+        import msgspec
+
+        class FeedItem(msgspec.Struct):
+            start: Optional[str] = None
+            end: Optional[str] = None
+            title: Optional[str] = None
+            url: Optional[str] = None
+
+            def __getitem__(self, key: str) -> Optional[str]:
+                return getattr(self, key)
+
+            def get(self, key: str, default: Any = None) -> Any:
+                return getattr(self, key, default)
+
+        _FEED_ITEMS_TYPE = List[FeedItem]
+    return _FEED_ITEMS_TYPE
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    started = False
+    finished = False
+    for chunk in _with_final(chunks):
+        final = chunk is None
+        buf = buf[pos:] + text_decoder.decode(chunk or b"", final=final)
+        pos = 0
+        while not finished:
+            pos = _WHITESPACE_RE.match(buf, pos).end()  # type: ignore
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Schedule feed must be a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] in ",]":
+                finished = buf[pos] == "]"
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            # 末尾の数値などは続きのチャンクがあるかもしれない
+            if end >= len(buf) and not final:
+                break
+            yield item
+            pos = end
+    if not finished:
+        raise ValueError("Schedule feed ended before the JSON array closed")
+
+
+def _with_final(chunks: Iterable[bytes]) -> Iterator[Optional[bytes]]:
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+    yield None
+
+
+class FeedCache:
+    directory: str
+    ttl: timedelta
+    max_bytes: int
+
+    def __init__(self, directory: str, *, ttl: timedelta,
+                 max_bytes: int) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        meta = self._load_meta(url)
+        if meta is None or not os.path.exists(self._path(url, "events")):
+            return {}
+        headers = {}
+        etag = meta.get("etag")
+        if etag:
+            headers["If-None-Match"] = etag
+        last_modified = meta.get("last_modified")
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def load_events(self, url: str) -> Optional[EventSnapshot]:
+        try:
+            return EventSnapshot(self._path(url, "events"))
+        except (OSError, ValueError):
+            return None
+
+    def fill(self, url: str, headers: Mapping[str, str],
+             chunks: Iterable[bytes], metrics: Optional[Metrics] = None,
+             json_backend: str = "stdlib") -> EventTable:
+        # 生のレスポンスを書き出しながらパースする
+        fd, body_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as body:
+                table = EventTable.from_events(
+                    iter_events(_tee_chunks(chunks, body), metrics=metrics,
+                                json_backend=json_backend))
+            write_snapshot(self._path(url, "events"), table)
+            os.replace(body_path, self._path(url, "body"))
+        except BaseException:
+            if os.path.exists(body_path):
+                os.remove(body_path)
+            raise
+        meta = {"url": url, "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified")}
+        self._write(url, "meta", json.dumps(meta).encode("utf-8"))
+        self.evict()
+        return table
+
+    def touch(self, url: str) -> None:
+        for kind in ["meta", "body", "events"]:
+            path = self._path(url, kind)
+            if os.path.exists(path):
+                os.utime(path)
+
+    def invalidate(self, url: str) -> None:
+        for kind in ["meta", "body", "events"]:
+            path = self._path(url, kind)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self) -> None:
+        # 複数のフィードを同時に取得しているときに同じファイルを消し合わないようにする
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries: Dict[str, List[os.DirEntry]] = {}
+        for entry in os.scandir(self.directory):
+            key, _, kind = entry.name.partition(".")
+            if kind in ["meta", "body", "events"]:
+                entries.setdefault(key, []).append(entry)
+        # 最終利用時刻が新しい順に残し、TTL と容量を超えた分を消す
+        expires = time.time() - self.ttl.total_seconds()
+        ordered = sorted(entries.values(), reverse=True,
+                         key=lambda files: max(f.stat().st_mtime
+                                               for f in files))
+        total = 0
+        for files in ordered:
+            total += sum(f.stat().st_size for f in files)
+            if total > self.max_bytes or \
+                    max(f.stat().st_mtime for f in files) < expires:
+                for f in files:
+                    os.remove(f.path)
+
+    def _path(self, url: str, kind: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.{kind}")
+
+    def _load_meta(self, url: str) -> Optional[Dict[str, Optional[str]]]:
+        try:
+            with open(self._path(url, "meta"), "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, url: str, kind: str, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(url, kind))
+
+
+class RenderCache:
+    # 同じイベントと期間から作ったメッセージを保存しておき、再実行時に使い回す
+    directory: str
+    ttl: timedelta
+    max_entries: int
+
+    # 描画の仕組みを変えて同じ入力から違うメッセージになるときに上げる
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory: str, *, ttl: timedelta,
+                 max_entries: int) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, events: Iterable[Event], now: datetime, week: bool,
+            targets: List[Target],
+            templates: Optional[
+                Mapping[str, Mapping[str, MessageTemplate]]] = None,
+            max_length: Optional[int] = TWEET_MAX_LENGTH) -> str:
+        h = hashlib.sha256()
+        h.update(f"{self.FORMAT_VERSION}\0{max_length}\0".encode())
+        h.update(b"week" if week else b"day")
+        for target in targets:
+            day = now.astimezone(target.tz).date()
+            h.update(f"\0{target.tz}\0{target.locale}\0{day}".encode())
+        # 既定の文面も含める。更新で文面が変わったら描画し直す
+        if templates is None:
+            templates = DEFAULT_TEMPLATES
+        for locale in sorted(templates):
+            for name in sorted(templates[locale]):
+                source = templates[locale][name].source
+                h.update(f"\0{locale}\0{name}\0{source}".encode())
+        # 描画に使うイベントの内容そのものを版とみなす
+        for event in events:
+            h.update(f"\0{event.start.isoformat()}\0{event.end.isoformat()}"
+                     f"\0{event.title}\0{event.url}".encode())
+        return h.hexdigest()
+
+    def get(self, key: str, targets: List[Target]
+            ) -> Optional[List[Tuple[Target, List[str]]]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                rendered = json.loads(f.read().decode("utf-8"))
+            if time.time() - os.stat(path).st_mtime > \
+                    self.ttl.total_seconds():
+                return None
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(rendered, list) or len(rendered) != len(targets):
+            return None
+        return list(zip(targets, rendered))
+
+    def put(self, key: str,
+            results: List[Tuple[Target, List[str]]]) -> None:
+        data = json.dumps([messages for _, messages in results])
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data.encode("utf-8"))
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.name.endswith(".json")]
+        expires = time.time() - self.ttl.total_seconds()
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for i, entry in enumerate(entries):
+            if i >= self.max_entries or entry.stat().st_mtime < expires:
+                os.remove(entry.path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+
+class EventStore:
+    # イベントを SQLite に保存し、開始時刻のインデックスで期間を引く。
+    # フィードを取り直したときは全体との差分だけを書き込む
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = _connect_sqlite(path)
+        with self._lock, self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS events (
+                    feed TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    start_offset INTEGER NOT NULL,
+                    "end" INTEGER NOT NULL,
+                    end_offset INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    url TEXT,
+                    PRIMARY KEY (feed, id)
+                );
+                CREATE INDEX IF NOT EXISTS events_start ON events (start);
+                CREATE TABLE IF NOT EXISTS feeds (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT
+                );
+                CREATE TABLE IF NOT EXISTS announcements (
+                    id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    announced_at INTEGER NOT NULL,
+                    PRIMARY KEY (id, kind)
+                );
+            """)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified FROM feeds WHERE url = ?",
+                (url,)).fetchone()
+        if row is None:
+            return {}
+        headers = {}
+        if row[0]:
+            headers["If-None-Match"] = row[0]
+        if row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def sync(self, url: str, events: Iterable[Event],
+             headers: Optional[Mapping[str, str]] = None,
+             metrics: Optional[Metrics] = None) -> Tuple[int, int, int]:
+        metrics = metrics if metrics is not None else Metrics()
+        rows = {}
+        for event in events:
+            rows[event_id(event)] = (
+                int(event.start.timestamp()), _utcoffset_seconds(event.start),
+                int(event.end.timestamp()), _utcoffset_seconds(event.end),
+                event.title, event.url)
+        with metrics.timer("store"), self._lock, self._db:
+            current = {row[0]: tuple(row[1:]) for row in self._db.execute(
+                'SELECT id, start, start_offset, "end", end_offset, title, url'
+                " FROM events WHERE feed = ?", (url,))}
+            added = [(url, i) + r for i, r in rows.items()
+                     if i not in current]
+            updated = [r + (url, i) for i, r in rows.items()
+                       if i in current and current[i] != r]
+            removed = [(url, i) for i in current if i not in rows]
+            self._db.executemany(
+                'INSERT INTO events (feed, id, start, start_offset, "end",'
+                " end_offset, title, url) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                added)
+            self._db.executemany(
+                'UPDATE events SET start = ?, start_offset = ?, "end" = ?,'
+                " end_offset = ?, title = ?, url = ?"
+                " WHERE feed = ? AND id = ?", updated)
+            self._db.executemany(
+                "DELETE FROM events WHERE feed = ? AND id = ?", removed)
+            headers = headers if headers is not None else {}
+            self._db.execute(
+                "INSERT OR REPLACE INTO feeds (url, etag, last_modified)"
+                " VALUES (?, ?, ?)",
+                (url, headers.get("ETag"), headers.get("Last-Modified")))
+        return len(added), len(updated), len(removed)
+
+    def select(self, since: Optional[datetime] = None,
+               until: Optional[datetime] = None,
+               url: Optional[str] = None) -> List[Event]:
+        conditions = []
+        params: List[Any] = []
+        if since is not None:
+            conditions.append("start >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            conditions.append("start < ?")
+            params.append(until.timestamp())
+        if url is not None:
+            conditions.append("feed = ?")
+            params.append(url)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT start, start_offset, "end", end_offset, title, url'
+                f" FROM events{where} ORDER BY start, id", params).fetchall()
+        return [Event(start=_from_timestamp(start, start_offset),
+                      end=_from_timestamp(end, end_offset),
+                      title=title, url=event_url)
+                for start, start_offset, end, end_offset, title, event_url
+                in rows]
+
+    def announced(self, events: Iterable[Event], kind: str) -> Set[str]:
+        ids = [event_id(event) for event in events]
+        with self._lock:
+            return {row[0] for row in self._db.execute(
+                "SELECT id FROM announcements WHERE kind = ? AND id IN"
+                f" ({', '.join('?' * len(ids))})", [kind] + ids)}
+
+    def mark_announced(self, events: Iterable[Event], kind: str,
+                       at: Optional[datetime] = None) -> None:
+        timestamp = int((at or datetime.now(timezone.utc)).timestamp())
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO announcements (id, kind, announced_at)"
+                " VALUES (?, ?, ?)",
+                [(event_id(event), kind, timestamp) for event in events])
+
+
+def _connect_sqlite(path: str) -> "sqlite3.Connection":
+    import sqlite3
+    # デーモンでは更新と投稿が別のスレッドから使うので、ロックで守る
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def event_id(event: Event) -> str:
+    # フィードにイベントの ID はないので、開始時刻とタイトルで同じイベントとみなす
+    key = f"{event.start.timestamp():.0f}\0{event.title}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _tee_chunks(chunks: Iterable[bytes], out: BinaryIO) -> Iterator[bytes]:
+    for chunk in chunks:
+        out.write(chunk)
+        yield chunk
+
+
+def _from_timestamp(timestamp: float, offset: int) -> datetime:
+    return datetime.fromtimestamp(timestamp, get_fixed_timezone(offset))
+
+
+def _utcoffset_seconds(dt: datetime) -> int:
+    offset = dt.utcoffset()
+    return int(offset.total_seconds()) if offset is not None else 0
+
+
+class PostError(Exception):
+    pass
+
+
+class PostRecord:
+    # 投稿済みのメッセージを覚えておき、再実行時に二重投稿しないようにする
+    path: str
+    scope: str
+    max_age: timedelta
+
+    def __init__(self, path: str, *, scope: str = "",
+                 max_age: timedelta = timedelta(days=30)) -> None:
+        self.path = path
+        self.scope = scope
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._posted: Dict[str, float] = {}
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self._posted = json.loads(f.read().decode("utf-8"))
+
+    def scoped(self, scope: str) -> "PostRecord":
+        # 同じファイルと記録を共有する、スコープだけが違う PostRecord。
+        # 送り先ごとに別々に読み書きすると互いの記録を上書きしてしまう
+        record = PostRecord.__new__(PostRecord)
+        record.__dict__.update(self.__dict__)
+        record.scope = scope
+        return record
+
+    def __contains__(self, message: str) -> bool:
+        with self._lock:
+            return self._key(message) in self._posted
+
+    def add(self, message: str) -> None:
+        with self._lock:
+            now = time.time()
+            expires = now - self.max_age.total_seconds()
+            for key in [k for k, t in self._posted.items() if t < expires]:
+                del self._posted[key]
+            self._posted[self._key(message)] = now
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(self._posted).encode("utf-8"))
+            os.replace(tmp_path, self.path)
+
+    def _key(self, message: str) -> str:
+        data = f"{self.scope}\n{message}".encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+
+class AnnouncementLedger:
+    # 告知済みの期間 ("2017-03-03 day" など) と、そのときのメッセージのハッシュを
+    # 覚えておく。追記だけの JSON Lines で、古い行が溜まったら書き直す
+    path: str
+    max_age: timedelta
+
+    # 行数が生きている期間の数の 2 倍とこの値の大きい方を超えたら書き直す
+    COMPACT_MIN_LINES = 64
+
+    def __init__(self, path: str, *, max_age: timedelta = timedelta(days=90),
+                 clock: Callable[[], float] = time.time) -> None:
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, Set[str]]] = {}
+        self._lines = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        data = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        # 追記の途中で止まった行は読み飛ばす
+                        continue
+                    self._entries[data["key"]] = (data["at"],
+                                                  set(data["hashes"]))
+                    self._lines += 1
+        self._expire()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Set[str]]:
+        # 告知済みならそのときのメッセージのハッシュ、まだなら None
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else None
+
+    def record(self, key: str, hashes: Iterable[str]) -> None:
+        with self._lock:
+            entry = (self._clock(), set(hashes))
+            self._entries[key] = entry
+            with open(self.path, "ab") as f:
+                f.write(self._line(key, entry))
+            self._lines += 1
+            if self._lines > max(2 * len(self._entries),
+                                 self.COMPACT_MIN_LINES):
+                self._expire()
+                self._compact()
+
+    def compact(self) -> None:
+        with self._lock:
+            self._expire()
+            self._compact()
+
+    @staticmethod
+    def message_hash(target: Target, message: str) -> str:
+        data = f"{target.tz} {target.locale}\n{message}".encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def _expire(self) -> None:
+        expires = self._clock() - self.max_age.total_seconds()
+        self._entries = {k: e for k, e in self._entries.items()
+                         if e[0] >= expires}
+
+    def _compact(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            for key, entry in self._entries.items():
+                f.write(self._line(key, entry))
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._entries)
+
+    @staticmethod
+    def _line(key: str, entry: Tuple[float, Set[str]]) -> bytes:
+        data = {"key": key, "at": entry[0], "hashes": sorted(entry[1])}
+        return (json.dumps(data) + "\n").encode("utf-8")
+
+
+class Sink(abc.ABC):
+    # メッセージの送り先。post_all はメッセージごとに、成功なら None を、
+    # 失敗なら例外を返す
+    name: str
+
+    @abc.abstractmethod
+    def post_all(self, messages: List[str],
+                 record: Optional[PostRecord] = None
+                 ) -> List[Optional[BaseException]]:
+        pass
+
+
+class HTTPSink(Sink):
+    # HTTP の API にメッセージを POST する。失敗は指数バックオフで再試行し、
+    # レート制限に達したら解除されるまで待つ
+    name = "webhook"
+    # 送った後に失敗しても再試行してよいか。サーバーが重複を判定する API だけ True
+    idempotent = False
+    session: "requests.Session"
+    endpoint: str
+    concurrency: int
+    max_retries: int
+    backoff: float
+    batch_size: int
+    timeout: Optional[float]
+
+    def __init__(self, session: "requests.Session", *, endpoint: str,
+                 concurrency: int = 1, max_retries: int = 3,
+                 backoff: float = 1.0, batch_size: int = 1,
+                 timeout: Optional[float] = 30.0,
+                 name: Optional[str] = None,
+                 metrics: Optional[Metrics] = None,
+                 sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.session = session
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.timeout = timeout
+        if name is not None:
+            self.name = name
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._sleep = sleep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+        import requests.adapters
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def post_all(self, messages: List[str],
+                 record: Optional[PostRecord] = None
+                 ) -> List[Optional[BaseException]]:
+        import concurrent.futures
+        # API が許す分だけまとめて 1 回で送る
+        batches = [messages[i:i + self.batch_size]
+                   for i in range(0, len(messages), self.batch_size)]
+        # concurrency が 1 のときはメッセージの順番どおりに投稿する
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            futures = [pool.submit(self.post_batch, b, record)
+                       for b in batches]
+        return [f.exception() for f, b in zip(futures, batches) for _ in b]
+
+    def post(self, message: str,
+             record: Optional[PostRecord] = None) -> None:
+        self.post_batch([message], record)
+
+    def post_batch(self, messages: List[str],
+                   record: Optional[PostRecord] = None) -> None:
+        import requests
+        if record is not None:
+            messages = [m for m in messages if m not in record]
+        if len(messages) == 0:
+            return
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            begin = time.perf_counter()
+            try:
+                response = self.session.post(self.endpoint,
+                                             timeout=self.timeout,
+                                             **self.request(messages))
+            except requests.RequestException as e:
+                self.metrics.count("post_errors")
+                # 送った後の失敗 (応答の待ち時間切れなど) では投稿済みかもしれない
+                retryable = self.idempotent or _request_not_sent(e)
+                if not retryable or attempt == self.max_retries:
+                    raise PostError(f"Failed to post a message: {e}")
+                self._sleep(self.backoff * 2 ** attempt)
+                continue
+            self.metrics.observe("post_latency_seconds",
+                                 time.perf_counter() - begin)
+            self._update_rate_limit(response)
+            if response.ok:
+                self.metrics.count("posts", len(messages))
+                self.metrics.count(f"posts_{self.name}", len(messages))
+                if record is not None:
+                    for message in messages:
+                        record.add(message)
+                return
+            retryable = response.status_code == 429 \
+                or response.status_code >= 500
+            if not retryable or attempt == self.max_retries:
+                raise PostError(f"Failed to post a message:"
+                                f" {response.status_code} {response.text}")
+            if response.status_code != 429:
+                self._sleep(self.backoff * 2 ** attempt)
+
+    def request(self, messages: List[str]) -> Dict[str, Any]:
+        # session.post に渡す引数
+        return {"json": {"text": "\n\n".join(messages)}}
+
+    def rate_limit_reset(self, response: "requests.Response"
+                         ) -> Optional[float]:
+        # レート制限が解除される epoch 秒。制限に達していなければ None
+        remaining = response.headers.get("x-rate-limit-remaining")
+        reset = response.headers.get("x-rate-limit-reset")
+        retry_after = response.headers.get("retry-after")
+        if response.status_code != 429 and remaining != "0":
+            return None
+        try:
+            if reset is not None:
+                return float(reset)
+            if retry_after is not None:
+                return self._clock() + float(retry_after)
+        except ValueError:
+            pass
+        return self._clock() + self.backoff
+
+    def _wait_for_rate_limit(self) -> None:
+        with self._lock:
+            delay = self._blocked_until - self._clock()
+        if delay > 0:
+            self._sleep(delay)
+
+    def _update_rate_limit(self, response: "requests.Response") -> None:
+        blocked_until = self.rate_limit_reset(response)
+        if blocked_until is None:
+            return
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, blocked_until)
+
+
+def _request_not_sent(e: "requests.RequestException") -> bool:
+    # 接続できなかったときだけ、リクエストが届いていないと言える
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError) or len(e.args) == 0:
+        return False
+    reason = getattr(e.args[0], "reason", e.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+class TwitterPoster(HTTPSink):
+    name = "twitter"
+
+    def __init__(self, session: "requests.Session", *,
+                 endpoint: str = TWITTER_ENDPOINT, **kwargs: Any) -> None:
+        super().__init__(session, endpoint=endpoint, **kwargs)
+
+    def request(self, messages: List[str]) -> Dict[str, Any]:
+        # ツイートはまとめられないので batch_size は 1
+        return {"json": {"text": messages[0]}}
+
+
+class SlackSink(HTTPSink):
+    # Incoming Webhook に送る。1 回の投稿にまとめ、ブロックで区切る
+    name = "slack"
+
+    def __init__(self, session: "requests.Session", *, endpoint: str,
+                 batch_size: int = 10, **kwargs: Any) -> None:
+        super().__init__(session, endpoint=endpoint, batch_size=batch_size,
+                         **kwargs)
+
+    def request(self, messages: List[str]) -> Dict[str, Any]:
+        blocks: List[Dict[str, Any]] = []
+        for message in messages:
+            if blocks:
+                blocks.append({"type": "divider"})
+            blocks.append({"type": "section",
+                           "text": {"type": "mrkdwn", "text": message}})
+        return {"json": {"text": "\n\n".join(messages), "blocks": blocks}}
+
+
+class MastodonSink(HTTPSink):
+    name = "mastodon"
+    idempotent = True
+
+    def __init__(self, session: "requests.Session", *, base_url: str,
+                 access_token: Optional[str] = None, **kwargs: Any) -> None:
+        if access_token is not None:
+            session.headers["Authorization"] = f"Bearer {access_token}"
+        super().__init__(session,
+                         endpoint=base_url.rstrip("/") + "/api/v1/statuses",
+                         **kwargs)
+
+    def request(self, messages: List[str]) -> Dict[str, Any]:
+        # 再試行で二重に投稿されないよう、サーバーにも重複を判定させる
+        key = hashlib.sha256(messages[0].encode("utf-8")).hexdigest()
+        return {"data": {"status": messages[0]},
+                "headers": {"Idempotency-Key": key}}
+
+    def rate_limit_reset(self, response: "requests.Response"
+                         ) -> Optional[float]:
+        remaining = response.headers.get("x-ratelimit-remaining")
+        reset = response.headers.get("x-ratelimit-reset")
+        if response.status_code != 429 and remaining != "0":
+            return None
+        try:
+            if reset is not None:
+                return parse_datetime(reset).timestamp()
+        except ValueError:
+            pass
+        return self._clock() + self.backoff
+
+
+SINKS = ["twitter", "slack", "mastodon", "webhook"]
+
+
+def deliver(sinks: List[Sink], messages: List[str],
+            records: Optional[Mapping[str, PostRecord]] = None
+            ) -> Dict[str, List[Optional[BaseException]]]:
+    import concurrent.futures
+    # 送り先ごとに別のスレッドで送るので、遅い送り先が他を待たせない
+    records = records if records is not None else {}
+    with concurrent.futures.ThreadPoolExecutor(max(len(sinks), 1)) as pool:
+        futures = {sink.name: pool.submit(sink.post_all, messages,
+                                          records.get(sink.name))
+                   for sink in sinks}
+    results: Dict[str, List[Optional[BaseException]]] = {}
+    for name, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            results[name] = [error for _ in messages]
+        else:
+            results[name] = future.result()
+    return results
+
+
+class Notifier:
+    feeds: List[Feed]
+    tz: tzinfo
+    locale: str
+    targets: List[Target]
+    dry_run: bool
+    cache: Optional[FeedCache]
+    post_record: Optional[str]
+
+    def __init__(self, *, feeds: List[Feed],
+                 credentials: Tuple[str, str, str, str],
+                 tz: tzinfo, locale: str, targets: List[Target],
+                 dry_run: bool, cache: Optional[FeedCache] = None,
+                 store: Optional[EventStore] = None,
+                 render_cache: Optional[RenderCache] = None,
+                 ledger: Optional[AnnouncementLedger] = None,
+                 repost: str = "never",
+                 json_backend: str = "stdlib",
+                 columnar: bool = False,
+                 templates: Optional[
+                     Mapping[str, Mapping[str, MessageTemplate]]] = None,
+                 post_concurrency: int = 1, post_retries: int = 3,
+                 post_timeout: Optional[float] = 30.0,
+                 post_record: Optional[str] = None,
+                 sinks: Optional[List[Tuple[str, Optional[str]]]] = None,
+                 mastodon_token: Optional[str] = None,
+                 metrics: Optional[Metrics] = None,
+                 metrics_file: Optional[str] = None) -> None:
+        self.feeds = feeds
+        self.tz = tz
+        self.locale = locale
+        self.targets = targets or [Target(tz, locale)]
+        self.templates = templates
+        self.dry_run = dry_run
+        self.cache = cache
+        self.store = store
+        self.render_cache = render_cache
+        self.ledger = ledger
+        # 告知済みの期間を "never": 飛ばす、"changed": 変わったメッセージだけ、
+        # "all": すべて投稿し直す
+        self.repost = repost
+        self.json_backend = json_backend
+        self.columnar = columnar
+        self.post_record = post_record
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_file = metrics_file
+        self._credentials = credentials
+        self._post_concurrency = post_concurrency
+        self._post_retries = post_retries
+        self._post_timeout = post_timeout
+        self._poster: Optional[TwitterPoster] = None
+        # (種類, URL) の組。既定は Twitter だけ
+        self.sink_specs = sinks or [("twitter", None)]
+        self._mastodon_token = mastodon_token
+        self._sinks: Optional[List[Sink]] = None
+        self._session: Optional["requests.Session"] = None
+        # デーモンでは通知とリマインダーが別のスレッドから投稿するので、
+        # 投稿と記録の更新、送り先の準備は一つずつ行う
+        self._lock = threading.RLock()
+
+    @property
+    def session(self) -> "requests.Session":
+        # デーモンでは取得のたびに同じ接続を使い回す
+        if self._session is None:
+            self._session = feed_session(len(self.feeds))
+        return self._session
+
+    def download(self, now: datetime, days: int) -> Optional[List[Event]]:
+        # イベントの開始時刻の UTC オフセット分だけ前後に余裕を持たせる
+        today = [now.astimezone(t.tz).date() for t in self.targets]
+        since = min(today) - timedelta(days=1)
+        until = max(today) + timedelta(days=days + 1)
+        return download_feeds(self.feeds, since=since, until=until,
+                              cache=self.cache, metrics=self.metrics,
+                              store=self.store, session=self.session,
+                              json_backend=self.json_backend)
+
+    def notify_range(self, since: date, until: date, week: bool,
+                     now: datetime) -> None:
+        # 期間全体を一度だけ取得し、1 日 (週) ごとにできたそばから出力する
+        days = 7 if week else 1
+        events = download_feeds(
+            self.feeds, since=since - timedelta(days=1),
+            until=until + timedelta(days=days + 1), cache=self.cache,
+            metrics=self.metrics, store=self.store, session=self.session,
+            json_backend=self.json_backend)
+        if events is None:
+            return
+        mg = MessageGenerator(events=events, now=now, week=week,
+                              locale=self.locale, tz=self.tz,
+                              templates=self.templates)
+        indexes: Dict[tzinfo, EventIndex] = {}
+        if self.columnar:
+            with self.metrics.timer("index"):
+                for tz in {self.tz} | {t.tz for t in self.targets}:
+                    indexes[tz] = ColumnarEventIndex(events, tz)
+        windows = mg.iter_range_messages(since, until, self.targets, indexes)
+        while True:
+            with self.metrics.timer("render"):
+                window = next(windows, None)
+            if window is None:
+                break
+            first, results = window
+            if all(len(ms) == 0 for _, ms in results):
+                continue
+            kind = "week" if week else "day"
+            self.publish(results, f"{first.isoformat()} {kind}",
+                         heading=f"# {first.isoformat()}")
+
+    def notify(self, now: datetime, week: bool,
+               events: Optional[List[Event]] = None,
+               indexes: Optional[Dict[tzinfo, EventIndex]] = None) -> None:
+        scope = f"{now.date().isoformat()} {'week' if week else 'day'}"
+        announced = None
+        if self.ledger is not None:
+            # 告知済みなら取得も描画もしない
+            announced = self.ledger.get(scope)
+            if announced is not None and self.repost == "never":
+                self.metrics.count("ledger_hits")
+                click.echo(f"schedule-notifier: {scope} is already"
+                           " announced", err=True)
+                return
+        if events is None:
+            events = self.download(now, 7 if week else 1)
+            if events is None:
+                return
+        with self.metrics.timer("render"):
+            mg = MessageGenerator(events=events, now=now, week=week,
+                                  locale=self.locale, tz=self.tz,
+                                  templates=self.templates)
+            results = None
+            if self.render_cache is not None:
+                key = self.render_cache.key(events, now, week, self.targets,
+                                            self.templates)
+                results = self.render_cache.get(key, self.targets)
+                self.metrics.count("render_cache_hits" if results is not None
+                                   else "render_cache_misses")
+            if results is None:
+                results = mg.generate_messages_for_targets(self.targets,
+                                                           indexes)
+                if self.render_cache is not None:
+                    self.render_cache.put(key, results)
+        hashes = [AnnouncementLedger.message_hash(target, message)
+                  for target, ms in results for message in ms]
+        if announced is not None and self.repost == "changed":
+            results = [(target, [m for m in ms if AnnouncementLedger.
+                                 message_hash(target, m) not in announced])
+                       for target, ms in results]
+        with self._lock:
+            self.publish(results, scope)
+            if self.ledger is not None and not self.dry_run:
+                self.ledger.record(scope, hashes)
+            if self.store is not None and not self.dry_run:
+                self.store.mark_announced(mg.window_events(),
+                                          "week" if week else "day", now)
+
+    def remind(self, event: Event, now: datetime, before: timedelta) -> None:
+        with self._lock:
+            self._remind(event, now, before)
+
+    def _remind(self, event: Event, now: datetime,
+                before: timedelta) -> None:
+        if self.store is not None and self.store.announced([event],
+                                                           "reminder"):
+            return
+        results = []
+        for target in self.targets:
+            mg = MessageGenerator(events=[event], now=now, week=False,
+                                  locale=target.locale, tz=target.tz,
+                                  templates=self.templates)
+            results.append((target, [mg.generate_reminder_message(
+                event, before)]))
+        self.publish(results, f"{event.start.isoformat()} reminder")
+        if self.store is not None and not self.dry_run:
+            self.store.mark_announced([event], "reminder", now)
+
+    def publish(self, results: List[Tuple[Target, List[str]]],
+                scope: str, heading: Optional[str] = None) -> None:
+        with self._lock:
+            self._publish(results, scope, heading)
+
+    def _publish(self, results: List[Tuple[Target, List[str]]],
+                 scope: str, heading: Optional[str] = None) -> None:
+        messages = [message for _, ms in results for message in ms]
+        if self.dry_run:
+            if heading is not None:
+                print(heading)
+            for target, ms in results:
+                if len(results) > 1:
+                    print(f"## {target.tz} ({target.locale})")
+                for i, message in enumerate(ms):
+                    print(f"#{i + 1}\n{message}")
+            return
+        if len(messages) == 0:
+            return
+        self.metrics.count("messages", len(messages))
+        records = {}
+        if self.post_record is not None:
+            record = PostRecord(self.post_record)
+            for sink in self.sinks:
+                # Twitter は送り先を増やす前の記録をそのまま使えるようにする
+                sink_scope = scope if sink.name == "twitter" \
+                    else f"{scope} {sink.name}"
+                records[sink.name] = record.scoped(sink_scope)
+        with self.metrics.timer("post"):
+            outcomes_by_sink = deliver(self.sinks, messages, records)
+        failures = []
+        for name, outcomes in outcomes_by_sink.items():
+            errors = [e for e in outcomes if e is not None]
+            if len(errors) > 0:
+                self.metrics.count(f"post_failures_{name}", len(errors))
+                failures.append(
+                    f"{name}: failed to post {len(errors)} of"
+                    f" {len(messages)} messages: "
+                    + "; ".join(str(e) for e in errors))
+        if len(failures) > 0:
+            raise click.ClickException("\n".join(failures))
+
+    @property
+    def sinks(self) -> List[Sink]:
+        with self._lock:
+            return self._build_sinks()
+
+    def _build_sinks(self) -> List[Sink]:
+        if self._sinks is None:
+            import requests
+            sinks: List[Sink] = []
+            kinds: Dict[str, int] = {}
+            for kind, url in self.sink_specs:
+                options: Dict[str, Any] = {
+                    "concurrency": self._post_concurrency,
+                    "max_retries": self._post_retries,
+                    "timeout": self._post_timeout,
+                    "metrics": self.metrics,
+                }
+                # 同じ種類の送り先が複数あれば名前に番号を付ける
+                kinds[kind] = kinds.get(kind, 0) + 1
+                if kinds[kind] > 1:
+                    options["name"] = f"{kind}-{kinds[kind]}"
+                sink: Sink
+                if kind == "twitter":
+                    sink = self.poster
+                elif kind == "slack" and url is not None:
+                    sink = SlackSink(requests.Session(), endpoint=url,
+                                     **options)
+                elif kind == "mastodon" and url is not None:
+                    sink = MastodonSink(requests.Session(), base_url=url,
+                                        access_token=self._mastodon_token,
+                                        **options)
+                elif kind == "webhook" and url is not None:
+                    sink = HTTPSink(requests.Session(), endpoint=url,
+                                    **options)
+                else:
+                    raise ValueError(f"Invalid sink '{kind}'")
+                sinks.append(sink)
+            self._sinks = sinks
+        return self._sinks
+
+    @property
+    def poster(self) -> TwitterPoster:
+        with self._lock:
+            return self._build_poster()
+
+    def _build_poster(self) -> TwitterPoster:
+        if self._poster is None:
+            from requests_oauthlib import OAuth1Session
+            twitter_client = OAuth1Session(*self._credentials)
+            self._poster = TwitterPoster(twitter_client,
+                                         concurrency=self._post_concurrency,
+                                         max_retries=self._post_retries,
+                                         timeout=self._post_timeout,
+                                         metrics=self.metrics)
+        return self._poster
+
+    def write_metrics(self) -> None:
+        if self.metrics_file is not None:
+            self.metrics.write(self.metrics_file)
+
+
+class CronSchedule:
+    expression: str
+    tz: tzinfo
+
+    def __init__(self, expression: str, tz: tzinfo) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression '{expression}'")
+        self.expression = expression
+        self.tz = tz
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = set(_parse_cron_field(fields[2], 1, 31))
+        self.months = set(_parse_cron_field(fields[3], 1, 12))
+        # 0 と 7 はどちらも日曜日
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def matches(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        day_matches = day.day in self.days
+        weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+        # 日と曜日の両方が指定されたときは、どちらかに一致すればよい
+        if self._any_day or self._any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, dt: datetime) -> datetime:
+        local = dt.astimezone(self.tz).replace(tzinfo=None)
+        day = local.date()
+        # 2/29 だけの指定でも見つかるように 8 年分探す
+        for _ in range(366 * 8):
+            if self.matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime(day.year, day.month, day.day,
+                                             hour, minute)
+                        if candidate > local:
+                            return localize(candidate, self.tz)
+            day += timedelta(days=1)
+        raise ValueError(f"'{self.expression}' never matches")
+
+
+def _parse_cron_field(field: str, lo: int, hi: int) -> List[int]:
+    values: Set[int] = set()
+    for part in field.split(","):
+        spec, _, step = part.partition("/")
+        try:
+            if spec == "*":
+                first, last = lo, hi
+            elif "-" in spec:
+                first, last = (int(v) for v in spec.split("-", 1))
+            else:
+                first = last = int(spec)
+            increment = int(step) if step else 1
+        except ValueError:
+            raise ValueError(f"Invalid cron field '{field}'")
+        if not lo <= first <= last <= hi or increment < 1:
+            raise ValueError(f"Invalid cron field '{field}'")
+        values.update(range(first, last + 1, increment))
+    return sorted(values)
+
+
+def localize(dt: datetime, tz: tzinfo) -> datetime:
+    # pytz のタイムゾーンは replace(tzinfo=...) では正しいオフセットにならない
+    if hasattr(tz, "localize"):
+        return tz.localize(dt)  # type: ignore
+    return dt.replace(tzinfo=tz)
+
+
+class Scheduler:
+    # 実行時刻順のヒープ。ジョブが次の実行時刻を返したら登録し直す
+    def __init__(self, clock: Callable[[], float] = time.time) -> None:
+        self._clock = clock
+        self._queue: List[Tuple[float, int, Callable[[], Optional[float]]]] \
+            = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def schedule(self, when: float,
+                 job: Callable[[], Optional[float]]) -> None:
+        with self._lock:
+            heapq.heappush(self._queue, (when, next(self._counter), job))
+        self._wakeup.set()
+
+    def run_pending(self) -> Optional[float]:
+        while True:
+            with self._lock:
+                if len(self._queue) == 0:
+                    return None
+                when, _, job = self._queue[0]
+                if when > self._clock():
+                    return when
+                heapq.heappop(self._queue)
+            next_when = job()
+            if next_when is not None:
+                self.schedule(next_when, job)
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            deadline = self.run_pending()
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - self._clock())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+
+class ReminderEngine:
+    # イベントの開始 remind_before 前に remind を呼ぶ。期限順のヒープの先頭まで眠り、
+    # フィードが更新されたら変わったイベントの分だけ入れ替える
+    remind_before: timedelta
+
+    def __init__(self, remind: Callable[[Event], None], *,
+                 remind_before: timedelta,
+                 categorizer: Optional[Categorizer] = None,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.remind_before = remind_before
+        if categorizer is None:
+            categorizer = DEFAULT_CATEGORIZER
+        self.categorizer = categorizer
+        self._remind = remind
+        self._clock = clock
+        # ヒープの要素は [期限, 順番, event_id, イベント]。取り消したらイベントを None にする
+        self._queue: List[List[Any]] = []
+        self._entries: Dict[str, List[Any]] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, events: Iterable[Event]) -> None:
+        now = self._clock()
+        before = self.remind_before.total_seconds()
+        with self._lock:
+            stale = set(self._entries)
+            for event in events:
+                if self.categorizer.categorize(event.title) is None:
+                    continue
+                key = event_id(event)
+                entry = self._entries.get(key)
+                if entry is not None:
+                    # 開始時刻とタイトルが同じなら、終了時刻や URL の変更はその場で反映する
+                    stale.discard(key)
+                    entry[3] = event
+                    continue
+                when = event.start.timestamp() - before
+                if when <= now:
+                    continue
+                entry = [when, next(self._counter), key, event]
+                self._entries[key] = entry
+                heapq.heappush(self._queue, entry)
+            # 更新されたフィードから消えたイベントには通知しない
+            for key in stale:
+                self._entries.pop(key)[3] = None
+            if len(self._queue) > 2 * len(self._entries) + 64:
+                self._queue = [e for e in self._queue if e[3] is not None]
+                heapq.heapify(self._queue)
+        self._wakeup.set()
+
+    def next_deadline(self) -> Optional[float]:
+        with self._lock:
+            return self._peek()
+
+    def run_pending(self) -> Optional[float]:
+        while True:
+            with self._lock:
+                deadline = self._peek()
+                if deadline is None or deadline > self._clock():
+                    return deadline
+                _, _, key, event = heapq.heappop(self._queue)
+                del self._entries[key]
+            self._remind(event)
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            deadline = self.run_pending()
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - self._clock())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def wakeup(self) -> None:
+        self._wakeup.set()
+
+    def _peek(self) -> Optional[float]:
+        while len(self._queue) > 0 and self._queue[0][3] is None:
+            heapq.heappop(self._queue)
+        return self._queue[0][0] if len(self._queue) > 0 else None
+
+
+class Daemon:
+    notifier: Notifier
+    daily: CronSchedule
+    weekly: CronSchedule
+    refresh_interval: int
+    remind_before: timedelta
+
+    def __init__(self, notifier: Notifier, *, daily: CronSchedule,
+                 weekly: CronSchedule, refresh_interval: int,
+                 remind_before: timedelta,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.notifier = notifier
+        self.daily = daily
+        self.weekly = weekly
+        self.refresh_interval = refresh_interval
+        self.remind_before = remind_before
+        # イベントとそのインデックスは別のスレッドから読まれるので、組で差し替える
+        self._state: Tuple[List[Event], Dict[tzinfo, EventIndex]] = ([], {})
+        self.scheduler = Scheduler(clock)
+        self.reminders = ReminderEngine(self._remind,
+                                        remind_before=remind_before,
+                                        clock=clock)
+        self._clock = clock
+        self._stop = threading.Event()
+
+    @property
+    def events(self) -> List[Event]:
+        return self._state[0]
+
+    def run(self) -> None:
+        self.start()
+        try:
+            self.scheduler.run(self._stop)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self) -> None:
+        # フィードの更新は通知とは別のスレッドで行う
+        self.refresh()
+        thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        thread.start()
+        if self.remind_before > timedelta(0):
+            thread = threading.Thread(target=self.reminders.run,
+                                      args=(self._stop,), daemon=True)
+            thread.start()
+        self.schedule_jobs()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.scheduler.wakeup()
+        self.reminders.wakeup()
+
+    def schedule_jobs(self) -> None:
+        for schedule, week in [(self.daily, False), (self.weekly, True)]:
+            self.scheduler.schedule(self._next_run(schedule),
+                                    self._notify_job(schedule, week))
+
+    def refresh(self) -> None:
+        # 直近 1 週間分のイベントだけをメモリに置いておく
+        events = self._run_safely(
+            lambda: self.notifier.download(self._now(), 8))
+        if events is None:
+            return
+        self._state = (events, {})
+        if self.remind_before > timedelta(0):
+            self.reminders.update(events)
+
+    def _refresh_loop(self) -> None:
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def _remind(self, event: Event) -> None:
+        self._run_safely(lambda: self.notifier.remind(
+            event, self._now(), self.remind_before))
+
+    def _notify_job(self, schedule: CronSchedule,
+                    week: bool) -> Callable[[], Optional[float]]:
+        def job() -> Optional[float]:
+            events, indexes = self._state
+            self._run_safely(lambda: self.notifier.notify(
+                self._now(), week, events=events, indexes=indexes))
+            self._run_safely(self.notifier.write_metrics)
+            return self._next_run(schedule)
+        return job
+
+    def _next_run(self, schedule: CronSchedule) -> float:
+        return schedule.next_after(self._now()).timestamp()
+
+    def _now(self) -> datetime:
+        return datetime.fromtimestamp(self._clock(), self.notifier.tz)
+
+    def _run_safely(self, func: Callable[[], Any]) -> Any:
+        # 一時的な失敗で常駐プロセスが止まらないようにする
+        try:
+            return func()
+        except Exception as e:
+            click.echo(f"schedule-notifier: {e}", err=True)
+            return None
+
+
+class BadRequest(ValueError):
+    # クエリの誤り。HTTP では 400 で答える
+    pass
+
+
+class ServerState(NamedTuple):
+    # 更新のたびに丸ごと差し替える。応答はこの状態ごとに覚えておく
+    events: List[Event]
+    starts: List[float]
+    indexes: Dict[tzinfo, EventIndex]
+    responses: Dict[Tuple[str, str], Tuple[str, bytes, Optional[bytes]]]
+
+
+class ScheduleServer:
+    # スケジュールを一度だけ取得・解析し、HTTP でメッセージとイベントを配る
+    notifier: Notifier
+    refresh_interval: float
+    max_responses: int
+
+    def __init__(self, notifier: Notifier, *, refresh_interval: float,
+                 max_responses: int = 1024,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.notifier = notifier
+        self.refresh_interval = refresh_interval
+        self.max_responses = max_responses
+        self._clock = clock
+        self.port: Optional[int] = None
+        self._state = ServerState([], [], {}, {})
+        self._timezones: Dict[str, tzinfo] = {}
+        self._server: Any = None
+        self._refresher: Any = None
+
+    def run(self, host: str, port: int) -> None:
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.start(host, port))
+            click.echo(f"Serving on http://{host}:{self.port}/", err=True)
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.close())
+            loop.close()
+
+    async def start(self, host: str, port: int) -> None:
+        import asyncio
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.refresh)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._refresher = loop.create_task(self._refresh_loop())
+
+    async def close(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def refresh(self) -> None:
+        events = download_feeds(
+            self.notifier.feeds, cache=self.notifier.cache,
+            metrics=self.notifier.metrics, store=self.notifier.store,
+            session=self.notifier.session,
+            json_backend=self.notifier.json_backend)
+        if events is None:
+            return
+        events = sorted(events, key=lambda e: e.start)
+        # 既定のタイムゾーンのインデックスは差し替える前にここで作っておく
+        tz = self.notifier.tz
+        self._state = ServerState(events, [e.start.timestamp()
+                                           for e in events],
+                                  {tz: EventIndex(events, tz)}, {})
+
+    async def _refresh_loop(self) -> None:
+        import asyncio
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                click.echo(f"schedule-notifier: {e}", err=True)
+
+    async def _handle(self, reader: "asyncio.StreamReader",
+                      writer: "asyncio.StreamWriter") -> None:
+        from http import HTTPStatus
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.decode("latin-1").split()
+                if len(parts) != 3:
+                    break
+                method, target, version = parts
+                headers: Dict[str, str] = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > 0:
+                    await reader.readexactly(length)
+                await self._prepare(target)
+                status, response_headers, body = self.respond(
+                    method, target, headers)
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" or \
+                    version == "HTTP/1.1" and connection != "close"
+                response_headers["Content-Length"] = str(len(body))
+                response_headers["Connection"] = \
+                    "keep-alive" if keep_alive else "close"
+                head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                head += "".join(f"{k}: {v}\r\n"
+                                for k, v in response_headers.items())
+                writer.write(head.encode("latin-1") + b"\r\n")
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    async def _prepare(self, target: str) -> None:
+        # 初めてのタイムゾーンのインデックスはイベントループの外で作る
+        import asyncio
+        from urllib.parse import parse_qsl, urlsplit
+        url = urlsplit(target)
+        if url.path != "/messages":
+            return
+        try:
+            tz = self._timezone(dict(parse_qsl(url.query)).get("tz"))
+        except BadRequest:
+            return
+        state = self._state
+        if tz not in state.indexes:
+            loop = asyncio.get_event_loop()
+            index = await loop.run_in_executor(None, EventIndex,
+                                               state.events, tz)
+            state.indexes.setdefault(tz, index)
+
+    def respond(self, method: str, target: str, headers: Mapping[str, str]
+                ) -> Tuple[int, Dict[str, str], bytes]:
+        from urllib.parse import parse_qsl, urlencode, urlsplit
+        if method not in ("GET", "HEAD"):
+            return self._error(405, f"Method {method} is not allowed")
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        if url.path == "/messages" and "date" not in params:
+            # 既定の今日の日付は応答を探す前に決める。日付が変われば別の応答になる
+            try:
+                tz = self._timezone(params.get("tz"))
+            except BadRequest as e:
+                return self._error(400, str(e))
+            params["date"] = datetime.fromtimestamp(
+                self._clock(), tz).date().isoformat()
+        query = urlencode(sorted(params.items()))
+        state = self._state
+        cached = state.responses.get((url.path, query))
+        if cached is None:
+            data: Any
+            try:
+                if url.path == "/messages":
+                    data = self._messages(state, params)
+                elif url.path == "/events":
+                    data = self._events(state, params)
+                else:
+                    return self._error(404, f"{url.path} is not found")
+            except BadRequest as e:
+                return self._error(400, str(e))
+            except Exception as e:
+                # スケジュールの内容の誤りなど、リクエストのせいではないもの
+                click.echo(f"schedule-notifier: {e}", err=True)
+                return self._error(500, str(e))
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            cached = (etag, body, None)
+            if len(state.responses) >= self.max_responses:
+                state.responses.clear()
+            state.responses[url.path, query] = cached
+        etag, body, compressed = cached
+        response_headers = {
+            "Content-Type": "application/json; charset=utf-8",
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+        }
+        if etag in [t.strip() for t in
+                    headers.get("if-none-match", "").split(",")]:
+            return 304, response_headers, b""
+        if "gzip" in headers.get("accept-encoding", ""):
+            if compressed is None:
+                import gzip
+                compressed = gzip.compress(body)
+                state.responses[url.path, query] = (etag, body, compressed)
+            response_headers["Content-Encoding"] = "gzip"
+            body = compressed
+        return 200, response_headers, body
+
+    def _messages(self, state: ServerState,
+                  params: Mapping[str, str]) -> Dict[str, Any]:
+        tz = self._timezone(params.get("tz"))
+        locale = params.get("locale", self.notifier.locale)
+        if locale not in (self.notifier.templates or MESSAGES):
+            raise BadRequest(f"Unknown locale '{locale}'")
+        week = params.get("week", "0") in ("1", "true")
+        day = _parse_date(params["date"])
+        now = localize(datetime.combine(day, datetime.min.time()), tz)
+        index = state.indexes.get(tz)
+        if index is None:
+            index = EventIndex(state.events, tz)
+            state.indexes[tz] = index
+        mg = MessageGenerator(events=state.events, now=now, week=week,
+                              locale=locale, tz=tz, index=index,
+                              templates=self.notifier.templates)
+        return {"date": day.isoformat(), "week": week, "tz": str(tz),
+                "locale": locale, "messages": mg.generate_messages()}
+
+    def _events(self, state: ServerState,
+                params: Mapping[str, str]) -> List[Dict[str, Optional[str]]]:
+        tz = self._timezone(params.get("tz"))
+        lo, hi = 0, len(state.events)
+        # from と to はそのタイムゾーンの日付で、to の日も含む
+        if "from" in params:
+            since = localize(datetime.combine(
+                _parse_date(params["from"]), datetime.min.time()), tz)
+            lo = bisect.bisect_left(state.starts, since.timestamp())
+        if "to" in params:
+            until = localize(datetime.combine(
+                _parse_date(params["to"]) + timedelta(days=1),
+                datetime.min.time()), tz)
+            hi = bisect.bisect_left(state.starts, until.timestamp(), lo)
+        return [{"start": e.start.isoformat(), "end": e.end.isoformat(),
+                 "title": e.title, "url": e.url}
+                for e in state.events[lo:hi]]
+
+    def _timezone(self, name: Optional[str]) -> tzinfo:
+        if name is None:
+            return self.notifier.tz
+        tz = self._timezones.get(name)
+        if tz is None:
+            import pytz
+            try:
+                tz = pytz.timezone(name)
+            except pytz.UnknownTimeZoneError:
+                raise BadRequest(f"Unknown time zone '{name}'")
+            self._timezones[name] = tz
+        return tz
+
+    def _error(self, status: int,
+               message: str) -> Tuple[int, Dict[str, str], bytes]:
+        body = json.dumps({"error": message}).encode("utf-8")
+        return status, {"Content-Type": "application/json"}, body
+
+
+def _parse_date(value: str) -> date:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise BadRequest(f"Invalid date '{value}', expected YYYY-MM-DD")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+from datetime import timedelta
+from typing import Callable, List
+
+import time
+
+import app
+from benchmarks import feeds
+
+N_EVENTS = 300000
+N_DAYS = 365
+
+
+def measure(name: str,
+            build: Callable[[List[app.Event]], app.EventIndex]) -> float:
+    # Event は現地時刻の変換結果を覚えているので、毎回作り直す
+    events = [app.Event.from_json(data)
+              for data in feeds.iter_feed(N_EVENTS)]
+    since = feeds.recent_start() - timedelta(days=N_DAYS)
+    until = feeds.recent_start() + timedelta(days=feeds.RECENT_DAYS)
+    begin = time.perf_counter()
+    index = build(events)
+    built = time.perf_counter() - begin
+    selected = 0
+    for days in [1, 7]:
+        for _, events_by_title in index.iter_windows(since, until, days):
+            selected += sum(len(es) for es in events_by_title.values())
+    total = time.perf_counter() - begin
+    print(f"{name:>10}: index {built:.3f}s, day and week windows "
+          f"{total - built:.3f}s ({selected} events)")
+    return total
+
+
+def main() -> None:
+    tz = feeds.now().tzinfo
+    print(f"{N_EVENTS} events, {N_DAYS + feeds.RECENT_DAYS} days")
+    base = measure("EventIndex", lambda events: app.EventIndex(events, tz))
+    try:
+        columnar = measure(
+            "columnar", lambda events: app.ColumnarEventIndex(events, tz))
+    except ImportError:
+        print("numpy is not installed")
+        return
+    print(f"speedup: {base / columnar:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional
+
+import os
+import tempfile
+import tracemalloc
+
+import app
+
+N_EVENTS = 100000
+
+TITLES = ["Open", "Make", "Online Open", "Python Event"]
+
+
+class DictEvent:
+    # __slots__ 導入前の Event と同じ構造
+    def __init__(self, *, start: datetime, end: datetime, title: str,
+                 url: Optional[str]) -> None:
+        self.start = start
+        self.end = end
+        self.title = title
+        self.url = url
+
+
+def generate_events(cls, n: int) -> List:
+    tz = timezone(timedelta(hours=9))
+    base = datetime(2015, 1, 1, 17, tzinfo=tz)
+    events = []
+    for i in range(n):
+        start = base + timedelta(hours=i)
+        title = TITLES[i % len(TITLES)]
+        url = "https://example.com/" if title == "Python Event" else None
+        # フィードをパースしたときと同じく、文字列は行ごとに別のオブジェクトにする
+        events.append(cls(start=start, end=start + timedelta(hours=2),
+                          title="".join(title), url=url and "".join(url)))
+    return events
+
+
+def measure(name: str, build: Callable[[], object]) -> int:
+    tracemalloc.start()
+    obj = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    print(f"{name:>12}: {size / 1024 / 1024:8.1f} MiB"
+          f" ({size / N_EVENTS:.0f} bytes per event)")
+    return size
+
+
+def main() -> None:
+    measure("dict Event", lambda: generate_events(DictEvent, N_EVENTS))
+    measure("slots Event", lambda: generate_events(app.Event, N_EVENTS))
+    events = generate_events(app.Event, N_EVENTS)
+    measure("EventTable", lambda: app.EventTable.from_events(events))
+    with tempfile.TemporaryDirectory() as directory:
+        # mmap したページは Python のヒープに載らないので、開いた直後はほぼ 0
+        path = os.path.join(directory, "events.snapshot")
+        app.write_snapshot(path, app.EventTable.from_events(events))
+        measure("EventSnapshot", lambda: app.EventSnapshot(path))
+
+
+if __name__ == "__main__":
+    main()
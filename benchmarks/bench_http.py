@@ -0,0 +1,84 @@
+from datetime import timedelta
+from typing import List
+
+import asyncio
+import http.client
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from benchmarks import feeds
+from benchmarks.run import serve_file
+
+N_EVENTS = 10000
+N_CLIENTS = 8
+N_REQUESTS = 500
+
+
+def start_server(notifier: app.Notifier) -> app.ScheduleServer:
+    server = app.ScheduleServer(notifier, refresh_interval=3600)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start("127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server
+
+
+def client(port: int, targets: List[str], gzip: bool) -> List[float]:
+    headers = {"Accept-Encoding": "gzip"} if gzip else {}
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    latencies = []
+    for i in range(N_REQUESTS):
+        begin = time.perf_counter()
+        connection.request("GET", targets[i % len(targets)], headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - begin)
+    connection.close()
+    return latencies
+
+
+def load(name: str, port: int, targets: List[str], gzip: bool) -> None:
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(N_CLIENTS) as executor:
+        results = list(executor.map(lambda _: client(port, targets, gzip),
+                                    range(N_CLIENTS)))
+    elapsed = time.perf_counter() - begin
+    latencies = sorted(t for r in results for t in r)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{name:>16}: {len(latencies) / elapsed:8.0f} req/s, "
+          f"p50 {p50:.2f}ms, p99 {p99:.2f}ms")
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "schedule.json")
+        feeds.write_feed(path, N_EVENTS)
+        feed = serve_file(path)
+        url = f"http://127.0.0.1:{feed.server_port}/schedule.json"
+        notifier = app.Notifier(
+            feeds=[app.Feed(url)], credentials=("", "", "", ""),
+            tz=feeds.now().tzinfo, locale="ja", targets=[], dry_run=True)
+        begin = time.perf_counter()
+        server = start_server(notifier)
+        print(f"{N_EVENTS} events, ready in "
+              f"{time.perf_counter() - begin:.3f}s, "
+              f"{N_CLIENTS} clients x {N_REQUESTS} requests")
+        start = feeds.recent_start()
+        days = [(start + timedelta(days=i)).isoformat()
+                for i in range(28)]
+        messages = [f"/messages?date={d}" for d in days] + \
+            [f"/messages?date={d}&week=1" for d in days[::7]]
+        events = [f"/events?from={d}&to={d}" for d in days]
+        load("messages", server.port, messages, gzip=False)
+        load("messages (gzip)", server.port, messages, gzip=True)
+        load("events", server.port, events, gzip=False)
+        load("events (gzip)", server.port, events, gzip=True)
+        feed.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from typing import List
+
+import importlib
+import json
+import time
+
+import app
+from benchmarks import feeds
+
+N_EVENTS = 200000
+
+
+def measure(name: str, body: bytes, backend: str) -> float:
+    chunks = [body[i:i + app.FEED_CHUNK_SIZE]
+              for i in range(0, len(body), app.FEED_CHUNK_SIZE)]
+    # 日時のパースを除いたデコードだけの時間を測る
+    begin = time.perf_counter()
+    for _ in app.iter_feed_items(chunks, backend):
+        pass
+    decode = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for _ in app.iter_events(chunks, json_backend=backend):
+        pass
+    total = time.perf_counter() - begin
+    print(f"{name:>8}: decode {decode:.3f}s, decode and parse {total:.3f}s")
+    return decode
+
+
+def available_backends() -> List[str]:
+    backends = []
+    for backend in app.JSON_BACKENDS:
+        if backend != "stdlib":
+            try:
+                importlib.import_module(backend)
+            except ImportError:
+                print(f"{backend:>8}: not installed")
+                continue
+        backends.append(backend)
+    return backends
+
+
+def main() -> None:
+    body = json.dumps(list(feeds.iter_feed(N_EVENTS)),
+                      ensure_ascii=False).encode("utf-8")
+    print(f"{N_EVENTS} events, {len(body) / 1024 / 1024:.1f} MiB")
+    results = {backend: measure(backend, body, backend)
+               for backend in available_backends()}
+    for backend, elapsed in results.items():
+        if backend != "stdlib":
+            print(f"{backend} decode speedup: "
+                  f"{results['stdlib'] / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import time
+
+import dateutil.parser
+
+import app
+
+N_EVENTS = 100000
+
+
+def generate_timestamps(n: int) -> List[str]:
+    tz = timezone(timedelta(hours=9))
+    base = datetime(2015, 1, 1, 17, tzinfo=tz)
+    return [(base + timedelta(hours=i)).isoformat() for i in range(n)]
+
+
+def measure(name: str, parse, values: List[str]) -> float:
+    begin = time.perf_counter()
+    for value in values:
+        parse(value)
+    elapsed = time.perf_counter() - begin
+    print(f"{name:>10}: {elapsed:.3f}s ({elapsed / len(values) * 1e6:.2f}us"
+          " per timestamp)")
+    return elapsed
+
+
+def main() -> None:
+    # start と end の 2 つを 1 イベントとして数える
+    values = generate_timestamps(N_EVENTS * 2)
+    assert all(app.parse_datetime(v) == dateutil.parser.parse(v)
+               for v in values[:1000])
+    slow = measure("dateutil", dateutil.parser.parse, values)
+    fast = measure("fast path", app.parse_datetime, values)
+    print(f"speedup: {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from typing import Dict, List
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+N_RUNS = 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times() -> Dict[str, int]:
+    # -X importtime の出力から、モジュールごとの累積時間 (us) を取り出す
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def cli_time() -> float:
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, "app.py", "--help"], cwd=ROOT,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - begin
+
+
+def main() -> None:
+    runs: List[Dict[str, int]] = [import_times() for _ in range(N_RUNS)]
+    app_times = [r["app"] for r in runs]
+    print(f"import app: {statistics.median(app_times) / 1000:.1f}ms"
+          f" (median of {N_RUNS})")
+    last = runs[-1]
+    print("slowest imports:")
+    top = [(t, name) for name, t in last.items() if name != "app"]
+    for t, name in sorted(top, reverse=True)[:10]:
+        print(f"  {t / 1000:6.1f}ms {name}")
+    cli_times = [cli_time() for _ in range(N_RUNS)]
+    median = statistics.median(cli_times)
+    print(f"app.py --help: {median * 1000:.1f}ms (median of {N_RUNS})")
+
+
+if __name__ == "__main__":
+    main()
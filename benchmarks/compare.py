@@ -0,0 +1,57 @@
+from typing import Any, Dict, List, Tuple
+
+import argparse
+import json
+import sys
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float,
+            min_delta: float) -> List[Tuple[str, str, float, float]]:
+    # 相対値と絶対値の両方でしきい値を超えたものだけを回帰とみなす
+    regressions = []
+    for size, stages in new["results"].items():
+        base_stages = base["results"].get(size, {})
+        for stage, seconds in stages.items():
+            if stage not in base_stages:
+                continue
+            before = base_stages[stage]
+            if seconds > before * (1 + threshold) \
+                    and seconds - before > min_delta:
+                regressions.append((size, stage, before, seconds))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare two results of benchmarks.run.")
+    parser.add_argument("base", help="Results of the base revision.")
+    parser.add_argument("new", help="Results of the new revision.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown reported as a regression."
+                        " (default: 0.1)")
+    parser.add_argument("--min-delta", type=float, default=0.001,
+                        help="Ignore slowdowns smaller than this many"
+                        " seconds. (default: 0.001)")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{base['revision'][:12]} -> {new['revision'][:12]}")
+    for size, stages in new["results"].items():
+        for stage, seconds in stages.items():
+            before = base["results"].get(size, {}).get(stage)
+            if before is None:
+                continue
+            print(f"{size:>10} {stage:<24} {before * 1000:10.2f}ms"
+                  f" -> {seconds * 1000:10.2f}ms ({seconds / before:.2f}x)")
+    regressions = compare(base, new, args.threshold, args.min_delta)
+    for size, stage, before, seconds in regressions:
+        print(f"REGRESSION: {stage} with {size} events"
+              f" {before * 1000:.2f}ms -> {seconds * 1000:.2f}ms")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
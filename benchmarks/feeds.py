@@ -0,0 +1,74 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional
+
+import json
+import random
+
+JST = timezone(timedelta(hours=9))
+
+# 直近のこの日数は、1 日に各種類のイベントが高々 1 つになるように作る
+RECENT_DAYS = 60
+
+HISTORY_TITLES = [
+    ("Open", 0.5), ("Make", 0.15), ("Online Open", 0.15),
+    ("Python Event", 0.1), ("もくもく会", 0.05), ("", 0.05),
+]
+
+
+def iter_feed(n: int, seed: int = 0) -> Iterator[Dict[str, Optional[str]]]:
+    # 古い履歴は 1 時間おきに詰め込み、最後の RECENT_DAYS 日は実際の予定に近い形にする
+    rng = random.Random(seed)
+    recent = list(_iter_recent(rng))[:n]
+    history = n - len(recent)
+    start = datetime.combine(recent_start(), datetime.min.time()) \
+        .replace(tzinfo=JST) - timedelta(hours=history)
+    titles = [t for t, _ in HISTORY_TITLES]
+    weights = [w for _, w in HISTORY_TITLES]
+    for i in range(history):
+        title = rng.choices(titles, weights)[0]
+        yield _event(start + timedelta(hours=i), timedelta(hours=1), title)
+    yield from recent
+
+
+def recent_start() -> date:
+    return date(2020, 1, 1)
+
+
+def now() -> datetime:
+    # run.py で使う「現在時刻」。直近の期間の中ほど
+    day = recent_start() + timedelta(days=RECENT_DAYS // 2)
+    return datetime(day.year, day.month, day.day, 8, tzinfo=JST)
+
+
+def write_feed(path: str, n: int, seed: int = 0) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, event in enumerate(iter_feed(n, seed)):
+            if i > 0:
+                f.write(",\n")
+            f.write(json.dumps(event, ensure_ascii=False))
+        f.write("]")
+
+
+def _iter_recent(rng: random.Random) -> Iterator[Dict[str, Optional[str]]]:
+    for d in range(RECENT_DAYS):
+        day = datetime.combine(recent_start() + timedelta(days=d),
+                               datetime.min.time()).replace(tzinfo=JST)
+        if rng.random() < 0.6:
+            yield _event(day + timedelta(hours=17), timedelta(hours=3),
+                         "Open")
+            if rng.random() < 0.4:
+                yield _event(day + timedelta(hours=18), timedelta(hours=2),
+                             "Make")
+        if rng.random() < 0.2:
+            yield _event(day + timedelta(hours=21), timedelta(hours=2),
+                         "Online Open")
+        if rng.random() < 0.15:
+            yield _event(day + timedelta(hours=13), timedelta(hours=4),
+                         "Python Event", "https://example.com/")
+
+
+def _event(start: datetime, length: timedelta, title: str,
+           url: Optional[str] = None) -> Dict[str, Optional[str]]:
+    return {"start": start.isoformat(), "end": (start + length).isoformat(),
+            "url": url, "title": title}
@@ -0,0 +1,142 @@
+from datetime import timedelta
+from typing import Any, Callable, Dict, List
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import app
+from benchmarks import feeds
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def serve_file(path: str) -> http.server.HTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(app.FEED_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_size(n: int, repeat: int) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "schedule.json")
+        feeds.write_feed(path, n)
+        with open(path, "rb") as f:
+            body = f.read()
+        now = feeds.now()
+        tz = now.tzinfo
+        today = now.date()
+        since = today - timedelta(days=1)
+        until = today + timedelta(days=8)
+        chunks = [body[i:i + app.FEED_CHUNK_SIZE]
+                  for i in range(0, len(body), app.FEED_CHUNK_SIZE)]
+
+        results: Dict[str, float] = {}
+        data: List[Any] = json.loads(body.decode("utf-8"))
+        results["json_decode"] = measure(
+            lambda: json.loads(body.decode("utf-8")), repeat)
+        results["stream_decode"] = measure(
+            lambda: list(app.iter_json_array(chunks)), repeat)
+        events = [app.Event.from_json(d) for d in data]
+        results["from_json"] = measure(
+            lambda: [app.Event.from_json(d) for d in data], repeat)
+        results["stream_window"] = measure(
+            lambda: list(app.iter_events(chunks, since=since, until=until)),
+            repeat)
+        results["window_filter"] = measure(
+            lambda: app.EventIndex(events, tz).events_between(
+                today, today + timedelta(days=7)), repeat)
+        results["divide_events_by_title"] = measure(
+            lambda: app.divide_events_by_title(events), repeat)
+
+        mg = app.MessageGenerator(events=events, now=now, week=True)
+        events_by_title = mg.index.events_between(
+            today, today + timedelta(days=7))
+        results["render_week"] = measure(
+            lambda: mg.generate_week_messages(events_by_title), repeat)
+
+        server = serve_file(path)
+        url = f"http://127.0.0.1:{server.server_port}/schedule.json"
+        command = [sys.executable, os.path.join(ROOT, "app.py"), "--url", url,
+                   "--dry-run", "--week", "--now", now.isoformat()]
+        try:
+            results["main_dry_run"] = measure(
+                lambda: subprocess.run(command, stdout=subprocess.DEVNULL,
+                                       check=True), repeat)
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the feed to message pipeline.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma separated numbers of events in the feed."
+                        " (e.g. 1000,10000000)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Take the best of this many runs.")
+    parser.add_argument("--output", "-o", help="Write results as JSON.")
+    args = parser.parse_args()
+
+    report: Dict[str, Any] = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "results": {},
+    }
+    for n in (int(s) for s in args.sizes.split(",")):
+        results = run_size(n, args.repeat)
+        report["results"][str(n)] = results
+        for stage, seconds in results.items():
+            print(f"{n:>10} {stage:<24} {seconds * 1000:10.2f}ms")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,12 @@ setup(
         'pytz>=2016.10',
     ],
     extras_require={
+        "fast": [
+            "orjson>=3.0.0",
+        ],
+        "columnar": [
+            "numpy>=1.15.0",
+        ],
         "test": [
             "flake8>=3.4.0,<4.0.0",
             "mypy>=0.521,<1.0",
@@ -1,8 +1,27 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
+import asyncio
+import click
+import dateutil.parser
+import gzip
+import http.client
+import http.server
+import json
+import os
+import pickle
+import pstats
 import pytest
 import pytz
+import re
+import requests
+import socket
+import subprocess
+import sys
 import textwrap
+import threading
+import time
+
+from click.testing import CliRunner
 
 import app
 
@@ -54,6 +73,32 @@ class TestEvent:
         with pytest.raises(KeyError):
             app.Event.from_json(d)
 
+    def test_parse_datetime(self):
+        for value in ["2015-11-02T17:00:00+09:00",
+                      "2015-11-02T08:00:00Z",
+                      "2015-11-02T03:30:00-04:30",
+                      "2015-11-02 17:00:00+0900",
+                      "2015-11-02"]:
+            parsed = app.parse_datetime(value)
+            expected = dateutil.parser.parse(value)
+            assert parsed == expected
+            assert parsed.utcoffset() == expected.utcoffset()
+
+    def test_localize(self):
+        e = app.Event.from_json({
+            "start": "2019-04-01T08:00:00+09:00",
+            "end": "2019-04-01T10:00:00+09:00",
+            "url": None,
+            "title": "Open"
+        })
+        jst = pytz.timezone("Asia/Tokyo")
+        assert e.localize(jst) is e.localize(jst)
+        assert e.get_day_and_time(jst) == "04/01 (月) 08:00〜10:00"
+        assert e.get_day_and_time(pytz.utc) == "03/31 (日) 23:00〜01:00"
+        assert e.get_start(pytz.utc) == "23:00"
+        assert e.get_end(pytz.utc) == "01:00"
+        assert e.localize(pytz.utc).start.date() == date(2019, 3, 31)
+
     def test_generate_day_messages_with_open(self):
         tz = pytz.timezone("Asia/Tokyo")
         e = app.Event(
@@ -379,6 +424,35 @@ class TestEvent:
             お申し込みの上ご参加ください。
             みなさんのお越しをお待ちしています!!""")]
 
+    def test_generate_messages_for_targets(self):
+        jst = pytz.timezone("Asia/Tokyo")
+        e = app.Event(
+            start=jst.localize(datetime(2017, 3, 3, 8)),
+            end=jst.localize(datetime(2017, 3, 3, 12)),
+            url=None,
+            title="Open")
+        mg = app.MessageGenerator(
+            events=[e],
+            now=jst.localize(datetime(2017, 3, 3, 10)),
+            week=False)
+        results = mg.generate_messages_for_targets([
+            app.Target(jst, "ja"),
+            app.Target(jst, "en"),
+            app.Target(pytz.utc, "ja"),
+        ])
+        assert [t for t, _ in results] == [(jst, "ja"), (jst, "en"),
+                                           (pytz.utc, "ja")]
+        assert results[0][1] == mg.generate_messages()
+        assert results[1][1] == [textwrap.dedent(f"""\
+            CAMPHOR- HOUSE is open today from 08:00 to 12:00.
+            We look forward to seeing you!!
+            Here is the way to HOUSE
+            https://goo.gl/maps/qasTRtgjnoP2
+            Other open days are listed here
+            {SCHEDULE_LINK}""")]
+        # UTC ではイベントが前日 (3/2) の 23:00 開始になるので「本日」ではない
+        assert results[2][1] == []
+
     def test_generate_week_message_with_nothing(self):
         tz = pytz.timezone("Asia/Tokyo")
         mg = app.MessageGenerator(
@@ -527,3 +601,1274 @@ class TestEvent:
 
             お申し込みの上ご参加ください。
             みなさんのお越しをお待ちしています!!""")]
+
+    def test_generate_week_message_split_by_length(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        events = [
+            app.Event(start=tz.localize(datetime(2019, 4, d, 17)),
+                      end=tz.localize(datetime(2019, 4, d, 19)),
+                      url="https://example.com/" + "x" * 100,
+                      title=f"長いタイトルのイベント {i}")
+            for d in range(1, 8) for i in range(3)
+        ]
+        mg = app.MessageGenerator(
+            events=events,
+            now=tz.localize(datetime(2019, 4, 1, 10)),
+            week=True)
+        messages = mg.generate_messages()
+        assert len(messages) > 1
+        for message in messages:
+            assert app.tweet_length(message) <= app.TWEET_MAX_LENGTH
+            assert message.startswith("今週のイベント情報です！\n")
+            assert message.endswith("みなさんのお越しをお待ちしています!!")
+        # 分割しても各イベントはちょうど一度ずつ現れる
+        body = "".join(messages)
+        for i in range(3):
+            assert body.count(f"長いタイトルのイベント {i} ") == 7
+
+        mg = app.MessageGenerator(
+            events=events,
+            now=tz.localize(datetime(2019, 4, 1, 10)),
+            week=True, max_length=None)
+        assert len(mg.generate_messages()) == 1
+
+    def test_generate_messages_with_templates(self, tmpdir):
+        path = tmpdir.join("templates.json")
+        path.write(json.dumps({"ja": {
+            "day_other": "{title} は {start} から {end} まで",
+            "day_and_time": "{date}({weekday}) {start}-{end}",
+        }}))
+        templates = app.load_templates(str(path))
+        tz = pytz.timezone("Asia/Tokyo")
+        e = app.Event(start=tz.localize(datetime(2019, 4, 1, 17)),
+                      end=tz.localize(datetime(2019, 4, 1, 19)),
+                      url=None, title="Python Event")
+        mg = app.MessageGenerator(
+            events=[e], now=tz.localize(datetime(2019, 4, 1, 10)),
+            week=False, templates=templates)
+        assert mg.generate_messages() == ["Python Event は 17:00 から 19:00 まで"]
+        mg = app.MessageGenerator(
+            events=[e], now=tz.localize(datetime(2019, 4, 1, 10)),
+            week=True, templates=templates)
+        assert "Python Event 04/01(月) 17:00-19:00\n" \
+            in mg.generate_messages()[0]
+        # 既定の文言のキャッシュには影響しない
+        assert e.get_day_and_time(tz) == "04/01 (月) 17:00〜19:00"
+
+        for overrides in [{"fr": {}}, {"ja": {"unknown": ""}},
+                          {"ja": {"day_other": "{url}"}},
+                          {"ja": {"day_other": "{start:>5}"}}]:
+            path.write(json.dumps(overrides))
+            with pytest.raises(ValueError):
+                app.load_templates(str(path))
+
+
+class TestIterEvents:
+    def test_iter_events_across_chunk_boundaries(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        body = json.dumps([
+            {"start": "2017-03-03T17:00:00+09:00",
+             "end": "2017-03-03T19:00:00+09:00",
+             "url": None, "title": "開館"},
+            {"start": "2017-03-04T17:00:00+09:00",
+             "end": "2017-03-04T19:00:00+09:00",
+             "url": "https://example.com/", "title": "Python Event"},
+        ], ensure_ascii=False).encode("utf-8")
+        for size in [1, 2, 7, len(body)]:
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            events = list(app.iter_events(chunks))
+            assert [e.title for e in events] == ["開館", "Python Event"]
+            assert events[1].start == tz.localize(datetime(2017, 3, 4, 17))
+            assert events[1].url == "https://example.com/"
+
+    def test_iter_events_drops_events_outside_window(self):
+        body = json.dumps([
+            {"start": "2010-01-01T17:00:00+09:00", "end": "broken",
+             "url": None, "title": "Open"},
+            {"start": "2017-03-03T17:00:00+09:00",
+             "end": "2017-03-03T19:00:00+09:00",
+             "url": None, "title": "Open"},
+            {"start": "2030-01-01T17:00:00+09:00", "end": "broken",
+             "url": None, "title": "Open"},
+        ]).encode("utf-8")
+        events = list(app.iter_events([body], since=date(2017, 3, 2),
+                                      until=date(2017, 3, 5)))
+        assert len(events) == 1
+        assert events[0].start.date() == date(2017, 3, 3)
+
+    def test_iter_events_where_feed_is_truncated(self):
+        with pytest.raises(ValueError):
+            list(app.iter_events([b'[{"start": "2017-03-03T17:00:00']))
+
+    @pytest.mark.parametrize("json_backend", app.JSON_BACKENDS)
+    def test_iter_events_with_json_backend(self, json_backend):
+        if json_backend != "stdlib":
+            pytest.importorskip(json_backend)
+        body = json.dumps(FEED + [
+            {"start": "2030-01-01T17:00:00+09:00", "end": "broken",
+             "url": None, "title": "Open", "description": "ignored"},
+        ], ensure_ascii=False).encode("utf-8")
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+        events = list(app.iter_events(chunks, until=date(2020, 1, 1),
+                                      json_backend=json_backend))
+        assert [e.title for e in events] == ["Open", "Python Event"]
+        assert events[1].url == "https://example.com/"
+        assert events[1].start == datetime(2017, 3, 10, 8, tzinfo=pytz.utc)
+
+        for body in [b'[{"start": "2017-03-03T17:00:00', b'{}']:
+            with pytest.raises(ValueError):
+                list(app.iter_events([body], json_backend=json_backend))
+
+    def test_auto_json_backend_streams(self):
+        body = json.dumps(FEED).encode("utf-8")
+        read = []
+
+        def chunks():
+            for i in range(0, len(body), 16):
+                read.append(i)
+                yield body[i:i + 16]
+        # 既定の auto では本文をまとめて読まず、読んだ分からイベントを返す
+        events = app.iter_events(chunks(), json_backend="auto")
+        assert next(events).title == "Open"
+        assert len(read) < len(body) // 16
+
+    def test_resolve_json_backend(self):
+        assert app.resolve_json_backend("auto") in app.JSON_BACKENDS
+        assert app.resolve_json_backend("stdlib") == "stdlib"
+        with pytest.raises(ValueError):
+            app.resolve_json_backend("simplejson")
+
+
+FEED = [
+    {"start": "2017-03-03T17:00:00+09:00",
+     "end": "2017-03-03T19:00:00+09:00",
+     "url": None, "title": "Open"},
+    {"start": "2017-03-10T17:00:00+09:00",
+     "end": "2017-03-10T19:00:00+09:00",
+     "url": "https://example.com/", "title": "Python Event"},
+]
+
+
+@pytest.fixture
+def feed_server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        requests = []
+
+        def do_GET(self):
+            self.requests.append(dict(self.headers))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps(FEED).encode("utf-8")
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/schedule.json"
+    server.requests = Handler.requests
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestFeedCache:
+    def test_download_events_uses_cache_when_not_modified(
+            self, feed_server, tmpdir):
+        cache = app.FeedCache(str(tmpdir), ttl=timedelta(days=1),
+                              max_bytes=1024 * 1024)
+        events = app.download_events(feed_server.url, cache=cache)
+        assert [e.title for e in events] == ["Open", "Python Event"]
+        assert "If-None-Match" not in feed_server.requests[0]
+
+        events = app.download_events(feed_server.url, since=date(2017, 3, 9),
+                                     until=date(2017, 3, 11), cache=cache)
+        assert feed_server.requests[1]["If-None-Match"] == '"v1"'
+        assert [e.title for e in events] == ["Python Event"]
+        assert events[0].start == datetime(2017, 3, 10, 8, tzinfo=pytz.utc)
+        assert events[0].url == "https://example.com/"
+
+    def test_evict_by_size(self, feed_server, tmpdir):
+        cache = app.FeedCache(str(tmpdir), ttl=timedelta(days=1),
+                              max_bytes=1)
+        app.download_events(feed_server.url, cache=cache)
+        assert os.listdir(str(tmpdir)) == []
+        assert cache.request_headers(feed_server.url) == {}
+
+
+class TestDownloadFeeds:
+    def test_merge_feeds(self, feed_server, capsys):
+        metrics = app.Metrics()
+        feeds = [app.Feed(feed_server.url, timeout=5),
+                 app.Feed(feed_server.url + "?copy", timeout=5),
+                 app.Feed("http://127.0.0.1:1/schedule.json", timeout=5,
+                          required=False)]
+        events = app.download_feeds(feeds, metrics=metrics)
+        assert len(feed_server.requests) == 2
+        assert [e.title for e in events] == ["Open", "Python Event"]
+        assert metrics.counts["feed_failures"] == 1
+        assert "127.0.0.1:1" in capsys.readouterr().err
+
+        with pytest.raises(requests.ConnectionError):
+            app.download_feeds(feeds[:1] + [feeds[2]._replace(required=True)])
+
+    def test_merge_events(self):
+        tz = pytz.timezone("Asia/Tokyo")
+
+        def event(day, title):
+            return app.Event(start=tz.localize(datetime(2019, 4, day, 17)),
+                             end=tz.localize(datetime(2019, 4, day, 19)),
+                             title=title, url=None)
+
+        merged = app.merge_events([
+            [event(1, "Open"), event(3, "Open")],
+            [event(1, "Make"), event(1, "Open"), event(2, "Open")],
+            [],
+        ])
+        assert [(e.start.day, e.title) for e in merged] \
+            == [(1, "Open"), (1, "Make"), (2, "Open"), (3, "Open")]
+
+    def test_load_feeds(self, tmpdir):
+        path = tmpdir.join("feeds.json")
+        path.write(json.dumps([
+            "https://example.com/a.json",
+            {"url": "https://example.com/b.json", "timeout": 3,
+             "required": False}]))
+        assert app.load_feeds(str(path)) == [
+            app.Feed("https://example.com/a.json"),
+            app.Feed("https://example.com/b.json", 3, False)]
+        for entries in [[], [{"timeout": 3}],
+                        [{"url": "https://example.com/", "retry": 1}]]:
+            path.write(json.dumps(entries))
+            with pytest.raises(ValueError):
+                app.load_feeds(str(path))
+
+
+class TestRenderCache:
+    def test_notify_uses_rendered_messages(self, tmpdir, capsys):
+        tz = pytz.timezone("Asia/Tokyo")
+        render_cache = app.RenderCache(str(tmpdir), ttl=timedelta(days=1),
+                                       max_entries=2)
+        notifier = app.Notifier(
+            feeds=[], credentials=("", "", "", ""), tz=tz, locale="ja",
+            targets=[], dry_run=True, render_cache=render_cache)
+        events = [app.Event.from_json(d) for d in FEED]
+        now = tz.localize(datetime(2017, 3, 3, 10))
+        notifier.notify(now, False, events)
+        out = capsys.readouterr().out
+        assert out.startswith("#1\n本日の CAMPHOR- HOUSE の開館時間は")
+        assert notifier.metrics.counts["render_cache_misses"] == 1
+
+        notifier.notify(now + timedelta(hours=1), False, events)
+        assert capsys.readouterr().out == out
+        assert notifier.metrics.counts["render_cache_hits"] == 1
+
+        # イベントが変わったら描画し直す
+        events[0].title = "Make"
+        notifier.notify(now, False, events)
+        assert capsys.readouterr().out == ""
+        assert notifier.metrics.counts["render_cache_misses"] == 2
+
+        notifier.notify(now, True, events)
+        assert len(os.listdir(str(tmpdir))) == 2
+
+    def test_key_includes_default_wording(self, tmpdir, monkeypatch):
+        tz = pytz.timezone("Asia/Tokyo")
+        render_cache = app.RenderCache(str(tmpdir), ttl=timedelta(days=1),
+                                       max_entries=2)
+        events = [app.Event.from_json(d) for d in FEED]
+        now = tz.localize(datetime(2017, 3, 3, 10))
+        targets = [app.Target(tz, "ja")]
+        key = render_cache.key(events, now, False, targets)
+        assert render_cache.key(events, now, False, targets,
+                                max_length=140) != key
+        ja = dict(app.MESSAGES["ja"], day_open_footer="更新後の文面\n")
+        messages = dict(app.MESSAGES, ja=ja)
+        monkeypatch.setattr(app, "DEFAULT_TEMPLATES",
+                            app.compile_templates(messages))
+        assert render_cache.key(events, now, False, targets) != key
+
+
+class TestEventStore:
+    def test_download_events_into_store(self, feed_server, tmpdir):
+        store = app.EventStore(str(tmpdir.join("events.db")))
+        metrics = app.Metrics()
+        events = app.download_events(feed_server.url, store=store,
+                                     metrics=metrics)
+        assert [e.title for e in events] == ["Open", "Python Event"]
+        assert metrics.counts["events_added"] == 2
+
+        events = app.download_events(feed_server.url, since=date(2017, 3, 9),
+                                     until=date(2017, 3, 11), store=store)
+        assert feed_server.requests[1]["If-None-Match"] == '"v1"'
+        assert [e.title for e in events] == ["Python Event"]
+        assert events[0].start == datetime(2017, 3, 10, 8, tzinfo=pytz.utc)
+        assert events[0].start.utcoffset() == timedelta(hours=9)
+        assert events[0].url == "https://example.com/"
+        store.close()
+
+    def test_sync(self, tmpdir):
+        store = app.EventStore(str(tmpdir.join("events.db")))
+        tz = pytz.timezone("Asia/Tokyo")
+
+        def event(day, title, url=None):
+            return app.Event(start=tz.localize(datetime(2019, 4, day, 17)),
+                             end=tz.localize(datetime(2019, 4, day, 19)),
+                             title=title, url=url)
+
+        assert store.sync("a", [event(1, "Open"), event(2, "Make")]) \
+            == (2, 0, 0)
+        assert store.sync("b", [event(1, "Open")]) == (1, 0, 0)
+        # タイトルと開始時刻が同じなら同じイベントとして更新する
+        assert store.sync("a", [event(1, "Open", "https://example.com/"),
+                                event(3, "Open")]) == (1, 1, 1)
+        events = store.select(tz.localize(datetime(2019, 4, 1)),
+                              tz.localize(datetime(2019, 4, 3)), url="a")
+        assert [(e.start.day, e.title, e.url) for e in events] \
+            == [(1, "Open", "https://example.com/")]
+        assert events[0].start == tz.localize(datetime(2019, 4, 1, 17))
+        assert len(store.select()) == 3
+
+        assert store.announced(events, "day") == set()
+        store.mark_announced(events, "day")
+        assert store.announced(events, "day") == {app.event_id(events[0])}
+        assert store.announced(events, "reminder") == set()
+        store.close()
+
+
+class TestEventIndex:
+    def test_events_between(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        events = [
+            app.Event(start=tz.localize(datetime(2019, 4, d, 17)),
+                      end=tz.localize(datetime(2019, 4, d, 19)),
+                      url=None, title=title)
+            for d, title in [(8, "Open"), (3, "Open"), (1, "Open"),
+                             (3, "Make"), (2, "Python Event"), (2, " ")]
+        ]
+        # UTC では前日だが、JST では 4/1 のイベント
+        events.append(app.Event(
+            start=datetime(2019, 3, 31, 23, tzinfo=pytz.utc),
+            end=datetime(2019, 4, 1, 1, tzinfo=pytz.utc),
+            url=None, title="Online Open"))
+        index = app.EventIndex(events, tz)
+
+        events_by_title = index.events_between(date(2019, 4, 1),
+                                               date(2019, 4, 8))
+        assert [e.start.day for e in events_by_title["open"]] == [1, 3]
+        assert [e.start.day for e in events_by_title["make"]] == [3]
+        assert [e.title for e in events_by_title["other"]] == ["Python Event"]
+        assert len(events_by_title["online open"]) == 1
+
+        events_by_title = index.events_on(date(2019, 4, 8))
+        assert [e.start.day for e in events_by_title["open"]] == [8]
+        assert events_by_title["online open"] == []
+
+    def test_iter_windows(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        events = [
+            app.Event(start=tz.localize(datetime(2019, 4, d, 17)),
+                      end=tz.localize(datetime(2019, 4, d, 19)),
+                      url=None, title=title)
+            for d, title in [(1, "Open"), (3, "Open"), (3, "Make"),
+                             (9, "Open"), (20, "Python Event")]
+        ]
+        index = app.EventIndex(events, tz)
+        since, until = date(2019, 3, 31), date(2019, 4, 21)
+        for days in [1, 7]:
+            windows = list(index.iter_windows(since, until, days))
+            assert [first for first, _ in windows] == [
+                since + timedelta(days=i)
+                for i in range(0, (until - since).days, days)]
+            for first, events_by_title in windows:
+                assert events_by_title == index.events_between(
+                    first, first + timedelta(days=days))
+
+    def test_columnar(self):
+        pytest.importorskip("numpy")
+        events = [
+            app.Event.from_json(data) for data in FEED +
+            [{"start": f"2019-{m:02}-{d:02}T{h:02}:30:00+09:00",
+              "end": f"2019-{m:02}-{d:02}T{h + 1:02}:30:00+09:00",
+              "url": None, "title": title}
+             for m in [3, 10, 11, 12] for d in range(1, 29, 3)
+             for h, title in [(0, "Open"), (8, "Make"), (22, "Python"),
+                              (12, " ")]]]
+        since, until = date(2017, 2, 27), date(2019, 12, 1)
+        for name in ["Asia/Tokyo", "America/New_York", "UTC"]:
+            tz = pytz.timezone(name)
+            index = app.EventIndex(events, tz)
+            table = app.ColumnarEventIndex(app.EventTable.from_events(events),
+                                           tz)
+            columnar = app.ColumnarEventIndex(events, tz)
+            for days in [1, 7]:
+                windows = [
+                    [(first, {c: [(e.start, e.end, e.title, e.url)
+                                  for e in es]
+                              for c, es in events_by_title.items()})
+                     for first, events_by_title in
+                     i.iter_windows(since, until, days)]
+                    for i in [index, table, columnar]]
+                assert windows[0] == windows[1] == windows[2]
+            for week in [False, True]:
+                for day in [datetime(2017, 3, 3), datetime(2019, 11, 1)]:
+                    now = tz.localize(day)
+                    messages = [
+                        app.MessageGenerator(
+                            events=events, now=now, week=week, tz=tz,
+                            index=i).generate_messages()
+                        for i in [index, columnar]]
+                    assert messages[0] == messages[1]
+
+    def test_categorizer(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        categorizer = app.Categorizer({"Open": "open", "開館": "open",
+                                       "Make": "make"})
+        assert categorizer.categorize("OPEN") == "open"
+        assert categorizer.categorize("開館") == "open"
+        assert categorizer.categorize("Online Open") == "other"
+        assert categorizer.categorize(" ") is None
+
+        events = [
+            app.Event(start=tz.localize(datetime(2019, 4, 1, 17)),
+                      end=tz.localize(datetime(2019, 4, 1, 19)),
+                      url=None, title=title)
+            for title in ["開館", "Make", "Python Event", ""]
+        ]
+        events_by_title = categorizer.divide(events)
+        assert [e.title for e in events_by_title["open"]] == ["開館"]
+        assert [e.title for e in events_by_title["make"]] == ["Make"]
+        assert [e.title for e in events_by_title["other"]] == ["Python Event"]
+        assert events_by_title["online open"] == []
+
+        index = app.EventIndex(events, tz, categorizer)
+        assert len(index.events_on(date(2019, 4, 1))["open"]) == 1
+
+        with pytest.raises(ValueError):
+            app.Categorizer({"Open": "unknown"})
+
+
+class TestEventTable:
+    def test_select(self):
+        events = [app.Event.from_json(d) for d in reversed(FEED)]
+        table = app.EventTable.from_events(events)
+        assert len(table) == 2
+        assert table.strings == ["Python Event", "https://example.com/",
+                                 "Open"]
+
+        tz = pytz.timezone("Asia/Tokyo")
+        selected = table.select(tz.localize(datetime(2017, 3, 4)))
+        assert len(selected) == 1
+        assert selected[0].start == events[0].start
+        assert selected[0].start.utcoffset() == timedelta(hours=9)
+        assert selected[0].end == events[0].end
+        assert selected[0].title == "Python Event"
+        assert selected[0].url == "https://example.com/"
+
+        selected = table.select(until=tz.localize(datetime(2017, 3, 4)))
+        assert [e.title for e in selected] == ["Open"]
+        assert selected[0].url is None
+
+    def test_pickle(self):
+        table = app.EventTable.from_events(
+            app.Event.from_json(d) for d in FEED)
+        table = pickle.loads(pickle.dumps(table))
+        table.append(app.Event.from_json(FEED[0]))
+        assert table.title_ids.tolist() == [0, 1, 0]
+        assert len(table.strings) == 3
+
+
+class TestEventSnapshot:
+    def test_select(self, tmpdir):
+        tz = pytz.timezone("Asia/Tokyo")
+        events = [app.Event.from_json(d) for d in reversed(FEED)]
+        events.append(app.Event(start=datetime(2017, 3, 5, tzinfo=pytz.utc),
+                                end=datetime(2017, 3, 5, 1, tzinfo=pytz.utc),
+                                title="開館", url=None))
+        path = str(tmpdir.join("events.snapshot"))
+        app.write_snapshot(path, app.EventTable.from_events(events))
+
+        with app.EventSnapshot(path) as snapshot:
+            assert len(snapshot) == 3
+            assert [e.title for e in snapshot.select()] \
+                == ["Open", "開館", "Python Event"]
+            selected = snapshot.select(tz.localize(datetime(2017, 3, 4)),
+                                       tz.localize(datetime(2017, 3, 10)))
+            assert len(selected) == 1
+            assert selected[0].start == events[2].start
+            assert selected[0].start.utcoffset() == timedelta(0)
+            assert selected[0].url is None
+            last = snapshot[2]
+            assert last.start == events[0].start
+            assert last.end.utcoffset() == timedelta(hours=9)
+            assert last.url == "https://example.com/"
+            assert snapshot.select(tz.localize(datetime(2018, 1, 1))) == []
+
+    def test_invalid_file(self, tmpdir):
+        path = tmpdir.join("events.snapshot")
+        for data in [b"not a snapshot at all, clearly", b"CSNS"]:
+            path.write_binary(data)
+            with pytest.raises(ValueError):
+                app.EventSnapshot(str(path))
+
+    def test_snapshot_command(self, tmpdir):
+        feed = tmpdir.join("schedule.json")
+        feed.write(json.dumps(FEED))
+        output = str(tmpdir.join("events.snapshot"))
+        result = CliRunner().invoke(app.main, [
+            "snapshot", output, "--input", str(feed)])
+        assert result.exit_code == 0, result.output
+        with app.EventSnapshot(output) as snapshot:
+            assert [e.title for e in snapshot.select()] \
+                == ["Open", "Python Event"]
+
+
+class TestMain:
+    def test_dry_run_with_several_targets(self, feed_server):
+        runner = CliRunner()
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run", "--week",
+            "--now", "2017-03-09T10:00:00+09:00",
+            "--target", "Asia/Tokyo", "--target", "UTC:en"])
+        assert result.exit_code == 0, result.output
+        assert len(feed_server.requests) == 1
+        assert result.output == textwrap.dedent("""\
+            ## Asia/Tokyo (ja)
+            #1
+            今週のイベント情報です！
+            Python Event 03/10 (金) 17:00〜19:00
+            https://example.com/
+
+            お申し込みの上ご参加ください。
+            みなさんのお越しをお待ちしています!!
+            ## UTC (en)
+            #1
+            Events this week!
+            Python Event 03/10 (Fri) 08:00-10:00
+            https://example.com/
+
+            Please sign up before joining.
+            We look forward to seeing you!!
+            """)
+
+    def test_dry_run_with_range(self, feed_server):
+        runner = CliRunner()
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run",
+            "--from", "2017-03-01", "--to", "2017-03-10"])
+        assert result.exit_code == 0, result.output
+        assert len(feed_server.requests) == 1
+        assert result.output == textwrap.dedent(f"""\
+            # 2017-03-03
+            #1
+            本日の CAMPHOR- HOUSE の開館時間は17:00〜19:00です。
+            みなさんのお越しをお待ちしています!!
+            HOUSEの場所はこちら
+            https://goo.gl/maps/qasTRtgjnoP2
+            その他の開館日はこちら
+            {SCHEDULE_LINK}
+            # 2017-03-10
+            #1
+            「Python Event」を17:00〜19:00に開催します!
+            みなさんのお越しをお待ちしています!!
+            https://example.com/
+            """)
+
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run", "--week",
+            "--from", "2017-03-01", "--to", "2017-03-14"])
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith(
+            "# 2017-03-01\n#1\n今週の開館日です！\n03/03 (金) 17:00〜19:00\n")
+        assert "# 2017-03-08\n#1\n今週のイベント情報です！\n" in result.output
+
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run", "--from", "2017-03-01"])
+        assert result.exit_code == 2
+
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--from", "2017-03-01",
+            "--to", "2017-03-10"])
+        assert result.exit_code == 2
+        assert "--from and --to need --dry-run" in result.output
+        assert len(feed_server.requests) == 2
+
+    def test_dry_run_with_range_columnar(self, feed_server):
+        pytest.importorskip("numpy")
+        runner = CliRunner()
+        # 期間が 7 日の倍数でなく、最後の週が --to より後のイベントを含む
+        for week in [[], ["--week"]]:
+            outputs = [
+                runner.invoke(app.main, [
+                    "--url", feed_server.url, "--dry-run", "--target",
+                    "America/New_York:en", "--target", "Asia/Tokyo:ja",
+                    "--from", "2017-03-01", "--to", "2017-03-09"] +
+                    week + columnar)
+                for columnar in [[], ["--columnar"]]]
+            assert outputs[1].exit_code == 0, outputs[1].output
+            assert outputs[1].output == outputs[0].output
+
+    def test_columnar_needs_range(self, feed_server):
+        result = CliRunner().invoke(app.main, [
+            "--url", feed_server.url, "--dry-run", "--columnar"])
+        assert result.exit_code == 2
+        assert "it applies only with --from and --to" in result.output
+        assert len(feed_server.requests) == 0
+
+    def test_update_and_force_are_exclusive(self, tmpdir):
+        result = CliRunner().invoke(app.main, [
+            "--dry-run", "--ledger", str(tmpdir.join("ledger.jsonl")),
+            "--update", "--force"])
+        assert result.exit_code == 2
+        assert "--update and --force cannot be used together" \
+            in result.output
+
+    def test_dry_run_with_templates(self, feed_server, tmpdir):
+        path = tmpdir.join("templates.json")
+        path.write(json.dumps({"ja": {"week_other_header": "今週の予定\n"}}))
+        runner = CliRunner()
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run", "--week",
+            "--now", "2017-03-09T10:00:00+09:00",
+            "--templates", str(path)])
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith("#1\n今週の予定\nPython Event")
+
+        path.write(json.dumps({"ja": {"week_other_header": "{title}"}}))
+        result = runner.invoke(app.main, [
+            "--url", feed_server.url, "--dry-run",
+            "--templates", str(path)])
+        assert result.exit_code == 2
+        assert "Unknown fields in 'week_other_header'" in result.output
+
+
+@pytest.fixture
+def twitter_server():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        responses = []
+        posted = []
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            text = json.loads(self.rfile.read(length).decode("utf-8"))["text"]
+            status, headers = self.responses.pop(0) if self.responses \
+                else (201, {})
+            if status == 201:
+                self.posted.append(text)
+            body = b"{}"
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/2/tweets"
+    server.responses = Handler.responses
+    server.posted = Handler.posted
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestMetrics:
+    def test_metrics_file(self, feed_server, tmpdir):
+        runner = CliRunner()
+        json_path = str(tmpdir.join("metrics.json"))
+        prom_path = str(tmpdir.join("metrics.prom"))
+        profile_path = str(tmpdir.join("profile.out"))
+        for path in [json_path, prom_path]:
+            result = runner.invoke(app.main, [
+                "--url", feed_server.url, "--dry-run",
+                "--now", "2017-03-03T10:00:00+09:00",
+                "--metrics-file", path, "--profile", profile_path])
+            assert result.exit_code == 0, result.output
+
+        with open(json_path) as f:
+            metrics = json.load(f)
+        assert metrics["counts"] == {
+            "feed_bytes": len(json.dumps(FEED).encode("utf-8")),
+            "feed_items": 2,
+            "events_filtered": 1,
+            "events_in_window": 1,
+        }
+        for stage in ["fetch", "decode", "parse", "render", "total"]:
+            assert metrics["durations"][stage] >= 0
+        assert metrics["durations"]["total"] >= \
+            metrics["durations"]["render"]
+
+        with open(prom_path) as f:
+            prom = f.read()
+        assert 'schedule_notifier_stage_seconds{stage="render"}' in prom
+        assert "schedule_notifier_events_in_window 1\n" in prom
+        assert pstats.Stats(profile_path).total_calls > 0
+
+
+class TestTwitterPoster:
+    def test_post_all_retries_and_honors_rate_limit(self, twitter_server):
+        twitter_server.responses.extend([
+            (503, {}),
+            (429, {"x-rate-limit-remaining": "0",
+                   "x-rate-limit-reset": "1000"}),
+            (201, {"x-rate-limit-remaining": "0",
+                   "x-rate-limit-reset": "2000"}),
+        ])
+        sleeps = []
+        poster = app.TwitterPoster(
+            requests.Session(), endpoint=twitter_server.url,
+            backoff=0.5, sleep=sleeps.append, clock=lambda: 900.0)
+        errors = poster.post_all(["first", "second"])
+        assert errors == [None, None]
+        assert twitter_server.posted == ["first", "second"]
+        assert sleeps == [0.5, 100.0, 1100.0]
+        assert poster.metrics.counts["posts"] == 2
+        assert len(poster.metrics.observations["post_latency_seconds"]) == 4
+
+    def test_post_fails_after_retries(self, twitter_server):
+        twitter_server.responses.extend([(500, {}), (500, {}), (400, {})])
+        poster = app.TwitterPoster(
+            requests.Session(), endpoint=twitter_server.url,
+            max_retries=1, sleep=lambda s: None)
+        errors = poster.post_all(["first", "second"])
+        assert isinstance(errors[0], app.PostError)
+        assert isinstance(errors[1], app.PostError)
+        assert twitter_server.posted == []
+
+    def test_post_timeout_is_not_retried(self):
+        # 接続は受け付けるが応答しないサーバー
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        try:
+            url = f"http://127.0.0.1:{server.getsockname()[1]}/2/tweets"
+            sleeps = []
+            poster = app.TwitterPoster(requests.Session(), endpoint=url,
+                                       timeout=0.2, sleep=sleeps.append)
+            errors = poster.post_all(["first"])
+            assert isinstance(errors[0], app.PostError)
+            # 届いているかもしれないので送り直さない
+            assert sleeps == []
+            assert poster.metrics.counts["post_errors"] == 1
+
+            sink = app.MastodonSink(requests.Session(), base_url=url,
+                                    timeout=0.2, max_retries=1,
+                                    sleep=sleeps.append)
+            assert isinstance(sink.post_all(["first"])[0], app.PostError)
+            assert sleeps == [1.0]
+        finally:
+            server.close()
+
+    def test_connection_error_is_retried(self):
+        sleeps = []
+        poster = app.TwitterPoster(
+            requests.Session(), endpoint="http://127.0.0.1:1/2/tweets",
+            max_retries=2, sleep=sleeps.append)
+        assert isinstance(poster.post_all(["first"])[0], app.PostError)
+        assert sleeps == [1.0, 2.0]
+
+    def test_post_record_prevents_duplicate_posts(self, twitter_server,
+                                                  tmpdir):
+        path = str(tmpdir.join("posted.json"))
+        twitter_server.responses.extend([(201, {}), (500, {})])
+        record = app.PostRecord(path, scope="2017-03-03 day")
+        poster = app.TwitterPoster(
+            requests.Session(), endpoint=twitter_server.url, max_retries=0)
+        errors = poster.post_all(["first", "second"], record)
+        assert errors[0] is None
+        assert isinstance(errors[1], app.PostError)
+
+        record = app.PostRecord(path, scope="2017-03-03 day")
+        poster = app.TwitterPoster(
+            requests.Session(), endpoint=twitter_server.url)
+        assert poster.post_all(["first", "second"], record) == [None, None]
+        assert twitter_server.posted == ["first", "second"]
+
+        record = app.PostRecord(path, scope="2017-03-04 day")
+        assert "first" not in record
+
+
+class TestSinks:
+    def test_slack_sink_batches_messages(self, twitter_server):
+        sink = app.SlackSink(requests.Session(), endpoint=twitter_server.url,
+                             batch_size=2)
+        assert sink.post_all(["first", "second", "third"]) == [None] * 3
+        assert twitter_server.posted == ["first\n\nsecond", "third"]
+        assert sink.metrics.counts["posts_slack"] == 3
+
+    def test_mastodon_sink(self):
+        session = requests.Session()
+        sink = app.MastodonSink(session, base_url="https://example.com/",
+                                access_token="token", clock=lambda: 0.0)
+        assert sink.endpoint == "https://example.com/api/v1/statuses"
+        assert session.headers["Authorization"] == "Bearer token"
+        request = sink.request(["first"])
+        assert request["data"] == {"status": "first"}
+        assert request["headers"]["Idempotency-Key"] \
+            == sink.request(["first"])["headers"]["Idempotency-Key"]
+
+        response = requests.Response()
+        response.status_code = 429
+        response.headers["X-RateLimit-Reset"] = "1970-01-01T00:01:40Z"
+        assert sink.rate_limit_reset(response) == 100.0
+
+    def test_publish_reports_each_sink(self, twitter_server, tmpdir):
+        tz = pytz.timezone("Asia/Tokyo")
+        notifier = app.Notifier(
+            feeds=[], credentials=("", "", "", ""), tz=tz, locale="ja",
+            targets=[], dry_run=False, post_retries=0,
+            post_record=str(tmpdir.join("posted.json")),
+            sinks=[("webhook", twitter_server.url),
+                   ("slack", "http://127.0.0.1:1/hook")])
+        assert [s.name for s in notifier.sinks] == ["webhook", "slack"]
+        with pytest.raises(click.ClickException) as e:
+            notifier.publish([(app.Target(tz, "ja"), ["first", "second"])],
+                             "2017-03-03 day")
+        assert e.value.message.startswith(
+            "slack: failed to post 2 of 2 messages")
+        assert "webhook" not in e.value.message
+        assert twitter_server.posted == ["first", "second"]
+        assert notifier.metrics.counts["post_failures_slack"] == 2
+
+        # 記録は送り先ごとなので、失敗した Slack だけ送り直す
+        with pytest.raises(click.ClickException):
+            notifier.publish([(app.Target(tz, "ja"), ["first", "second"])],
+                             "2017-03-03 day")
+        assert twitter_server.posted == ["first", "second"]
+
+    def test_sink_is_abstract(self):
+        class Incomplete(app.Sink):
+            name = "incomplete"
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def test_rerun_with_several_sinks(self, twitter_server, tmpdir):
+        tz = pytz.timezone("Asia/Tokyo")
+        path = str(tmpdir.join("posted.json"))
+        for _ in range(2):
+            notifier = app.Notifier(
+                feeds=[], credentials=("", "", "", ""), tz=tz, locale="ja",
+                targets=[], dry_run=False, post_record=path,
+                sinks=[("webhook", twitter_server.url),
+                       ("webhook", twitter_server.url)])
+            notifier.publish(
+                [(app.Target(tz, "ja"), ["first", "second", "third"])],
+                "2017-03-03 day")
+            # 送り先どうしで記録を上書きしないので、再実行では何も投稿しない
+            assert sorted(twitter_server.posted) == \
+                sorted(["first", "second", "third"] * 2)
+            with open(path) as f:
+                assert len(json.load(f)) == 6
+
+    def test_concurrent_publish_keeps_every_record(self, twitter_server,
+                                                   tmpdir):
+        # デーモンでは通知とリマインダーが別のスレッドから投稿する
+        tz = pytz.timezone("Asia/Tokyo")
+        path = str(tmpdir.join("posted.json"))
+        notifier = app.Notifier(
+            feeds=[], credentials=("", "", "", ""), tz=tz, locale="ja",
+            targets=[], dry_run=False, post_record=path,
+            sinks=[("webhook", twitter_server.url)])
+        threads = [threading.Thread(target=notifier.publish, args=(
+            [(app.Target(tz, "ja"), [f"message {i}"])], f"scope {i}"))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(twitter_server.posted) == 8
+        with open(path) as f:
+            assert len(json.load(f)) == 8
+        assert len(notifier.sinks) == 1
+
+    def test_metrics_of_sinks_of_the_same_kind(self, twitter_server):
+        tz = pytz.timezone("Asia/Tokyo")
+        notifier = app.Notifier(
+            feeds=[], credentials=("", "", "", ""), tz=tz, locale="ja",
+            targets=[], dry_run=False,
+            sinks=[("webhook", twitter_server.url),
+                   ("webhook", twitter_server.url)])
+        notifier.publish([(app.Target(tz, "ja"), ["first"])],
+                         "2017-03-03 day")
+        assert notifier.metrics.counts["posts_webhook-2"] == 1
+        prom = notifier.metrics.to_prometheus()
+        assert "schedule_notifier_posts_webhook_2 1\n" in prom
+        for line in prom.splitlines():
+            if not line.startswith("#"):
+                assert re.match(r"[a-zA-Z_:][a-zA-Z0-9_:]*({.*})? \S+$",
+                                line), line
+
+
+class TestAnnouncementLedger:
+    def test_record_and_reload(self, tmpdir):
+        path = str(tmpdir.join("ledger.jsonl"))
+        ledger = app.AnnouncementLedger(path)
+        assert ledger.get("2017-03-03 day") is None
+        ledger.record("2017-03-03 day", ["a", "b"])
+        ledger.record("2017-03-03 week", [])
+        assert ledger.get("2017-03-03 day") == {"a", "b"}
+        # 追記の途中で止まった行は無視する
+        with open(path, "ab") as f:
+            f.write(b'{"key": "2017-03-04 day", "at"')
+
+        ledger = app.AnnouncementLedger(path)
+        assert ledger.get("2017-03-03 day") == {"a", "b"}
+        assert ledger.get("2017-03-03 week") == set()
+        assert ledger.get("2017-03-04 day") is None
+
+    def test_compact(self, tmpdir):
+        path = str(tmpdir.join("ledger.jsonl"))
+        clock = [0.0]
+        ledger = app.AnnouncementLedger(path, max_age=timedelta(days=1),
+                                        clock=lambda: clock[0])
+        ledger.COMPACT_MIN_LINES = 4
+        for i in range(4):
+            ledger.record("2017-03-03 day", [str(i)])
+        with open(path) as f:
+            assert len(f.readlines()) == 4
+        ledger.record("2017-03-03 day", ["4"])
+        with open(path) as f:
+            assert len(f.readlines()) == 1
+        assert ledger.get("2017-03-03 day") == {"4"}
+
+        clock[0] += 24 * 60 * 60 + 1
+        ledger.record("2017-03-05 day", [])
+        ledger.compact()
+        assert len(ledger) == 1
+        assert app.AnnouncementLedger(path).get("2017-03-03 day") is None
+
+    def test_notify_skips_announced(self, feed_server, twitter_server,
+                                    tmpdir):
+        tz = pytz.timezone("Asia/Tokyo")
+        ledger = app.AnnouncementLedger(str(tmpdir.join("ledger.jsonl")))
+        notifier = app.Notifier(
+            feeds=[app.Feed(feed_server.url)], credentials=("", "", "", ""),
+            tz=tz, locale="ja", targets=[], dry_run=False, ledger=ledger,
+            sinks=[("webhook", twitter_server.url)])
+        now = tz.localize(datetime(2017, 3, 3, 8))
+        notifier.notify(now, week=False)
+        assert len(twitter_server.posted) == 1
+        assert len(ledger.get("2017-03-03 day")) == 1
+
+        # 告知済みの日は取得もしない
+        notifier.notify(now, week=False)
+        assert len(feed_server.requests) == 1
+        assert len(twitter_server.posted) == 1
+        assert notifier.metrics.counts["ledger_hits"] == 1
+
+        notifier.repost = "changed"
+        notifier.notify(now, week=False)
+        assert len(feed_server.requests) == 2
+        assert len(twitter_server.posted) == 1
+        ledger.record("2017-03-03 day", [])
+        notifier.notify(now, week=False)
+        assert len(twitter_server.posted) == 2
+
+        notifier.repost = "all"
+        notifier.notify(now, week=False)
+        assert len(twitter_server.posted) == 3
+
+
+class TestCronSchedule:
+    def test_next_after(self):
+        tz = pytz.timezone("Asia/Tokyo")
+        daily = app.CronSchedule("0 8 * * *", tz)
+        assert daily.next_after(tz.localize(datetime(2017, 3, 3, 7, 59))) \
+            == tz.localize(datetime(2017, 3, 3, 8))
+        assert daily.next_after(tz.localize(datetime(2017, 3, 3, 8))) \
+            == tz.localize(datetime(2017, 3, 4, 8))
+        # 2017-03-03 23:00 UTC は JST の 3/4 8:00
+        weekly = app.CronSchedule("0 8 * * 1", tz)
+        assert weekly.next_after(datetime(2017, 3, 3, 23, tzinfo=pytz.utc)) \
+            == tz.localize(datetime(2017, 3, 6, 8))
+        every = app.CronSchedule("*/15 9-10 1,15 * 0", tz)
+        assert every.next_after(tz.localize(datetime(2017, 3, 3, 12))) \
+            == tz.localize(datetime(2017, 3, 5, 9))
+        assert every.next_after(tz.localize(datetime(2017, 3, 5, 10, 45))) \
+            == tz.localize(datetime(2017, 3, 12, 9))
+
+    def test_invalid_expression(self):
+        for expression in ["0 8 * *", "60 8 * * *", "0 8-7 * * *",
+                           "0 */0 * * *", "a 8 * * *"]:
+            with pytest.raises(ValueError):
+                app.CronSchedule(expression, pytz.utc)
+
+
+class TestDaemon:
+    def test_notify_on_schedule(self, feed_server, capsys):
+        tz = pytz.timezone("Asia/Tokyo")
+        clock = [tz.localize(datetime(2017, 3, 3, 7, 59)).timestamp()]
+        notifier = app.Notifier(
+            feeds=[app.Feed(feed_server.url)], credentials=("", "", "", ""),
+            tz=tz,
+            locale="ja", targets=[], dry_run=True)
+        daemon = app.Daemon(
+            notifier, daily=app.CronSchedule("0 8 * * *", tz),
+            weekly=app.CronSchedule("0 8 * * 1", tz), refresh_interval=600,
+            remind_before=timedelta(minutes=30), clock=lambda: clock[0])
+        daemon.refresh()
+        daemon.schedule_jobs()
+        assert [e.title for e in daemon.events] == ["Open", "Python Event"]
+
+        daemon.scheduler.run_pending()
+        assert capsys.readouterr().out == ""
+
+        clock[0] += 60
+        daemon.scheduler.run_pending()
+        out = capsys.readouterr().out
+        assert out.startswith("#1\n本日の CAMPHOR- HOUSE の開館時間は")
+        deadline = daemon.reminders.run_pending()
+        remind_at = tz.localize(datetime(2017, 3, 3, 16, 30))
+        assert deadline == remind_at.timestamp()
+
+        clock[0] = deadline
+        daemon.reminders.run_pending()
+        assert capsys.readouterr().out == \
+            "#1\n「Open」が30分後の17:00から始まります! (17:00〜19:00)\n"
+        assert len(feed_server.requests) == 1
+
+    def test_refresh_swaps_events_with_indexes(self, feed_server):
+        tz = pytz.timezone("Asia/Tokyo")
+        clock = [tz.localize(datetime(2017, 3, 3, 8)).timestamp()]
+        notifier = app.Notifier(
+            feeds=[app.Feed(feed_server.url)], credentials=("", "", "", ""),
+            tz=tz, locale="ja", targets=[], dry_run=True)
+        daemon = app.Daemon(
+            notifier, daily=app.CronSchedule("0 8 * * *", tz),
+            weekly=app.CronSchedule("0 8 * * 1", tz), refresh_interval=600,
+            remind_before=timedelta(0), clock=lambda: clock[0])
+        daemon.refresh()
+        events, indexes = daemon._state
+        # 古いイベントで通知している間に更新されても、そのインデックスは
+        # 新しいイベントの組に入らない
+        daemon.refresh()
+        notifier.notify(daemon._now(), False, events=events, indexes=indexes)
+        assert tz in indexes
+        assert daemon._state[1] == {}
+        assert daemon.events is not events
+
+
+class TestScheduleServer:
+    @pytest.fixture
+    def server(self, feed_server):
+        notifier = app.Notifier(
+            feeds=[app.Feed(feed_server.url)], credentials=("", "", "", ""),
+            tz=pytz.timezone("Asia/Tokyo"), locale="ja", targets=[],
+            dry_run=True)
+        server = app.ScheduleServer(notifier, refresh_interval=600)
+        server.refresh()
+        return server
+
+    def test_messages(self, server):
+        status, headers, body = server.respond(
+            "GET", "/messages?date=2017-03-03", {})
+        assert status == 200
+        data = json.loads(body.decode("utf-8"))
+        assert data["date"] == "2017-03-03"
+        assert data["messages"][0].startswith(
+            "本日の CAMPHOR- HOUSE の開館時間は17:00〜19:00です。")
+
+        _, _, body = server.respond(
+            "GET", "/messages?week=1&date=2017-03-06&locale=en", {})
+        data = json.loads(body.decode("utf-8"))
+        assert data["week"] is True
+        assert "Python Event" in "".join(data["messages"])
+
+    def test_messages_for_today(self, server):
+        tz = pytz.timezone("Asia/Tokyo")
+        clock = [tz.localize(datetime(2017, 3, 2, 23, 59)).timestamp()]
+        server._clock = lambda: clock[0]
+        _, headers, body = server.respond("GET", "/messages", {})
+        assert json.loads(body.decode("utf-8"))["date"] == "2017-03-02"
+
+        # 日付が変わったら、取得し直さなくても今日のメッセージを返す
+        clock[0] += 60
+        _, today, body = server.respond("GET", "/messages", {})
+        data = json.loads(body.decode("utf-8"))
+        assert data["date"] == "2017-03-03"
+        assert data["messages"][0].startswith("本日の CAMPHOR- HOUSE")
+        assert today["ETag"] != headers["ETag"]
+        assert server.respond(
+            "GET", "/messages?tz=UTC", {})[2] != body
+
+    def test_events(self, server):
+        _, _, body = server.respond(
+            "GET", "/events?from=2017-03-04&to=2017-03-10", {})
+        assert json.loads(body.decode("utf-8")) == [
+            {"start": "2017-03-10T17:00:00+09:00",
+             "end": "2017-03-10T19:00:00+09:00",
+             "url": "https://example.com/", "title": "Python Event"}]
+
+        _, _, body = server.respond(
+            "GET", "/events?to=2017-03-03&tz=UTC", {})
+        assert [e["title"] for e in json.loads(body.decode("utf-8"))] == \
+            ["Open"]
+
+    def test_etag_and_gzip(self, server):
+        _, headers, body = server.respond("GET", "/events", {})
+        status, _, empty = server.respond(
+            "GET", "/events", {"if-none-match": headers["ETag"]})
+        assert status == 304
+        assert empty == b""
+
+        status, gzipped, compressed = server.respond(
+            "GET", "/events", {"accept-encoding": "gzip, deflate"})
+        assert gzipped["Content-Encoding"] == "gzip"
+        assert gzipped["ETag"] == headers["ETag"]
+        assert gzip.decompress(compressed) == body
+
+    def test_errors(self, server):
+        assert server.respond("GET", "/nothing", {})[0] == 404
+        assert server.respond("POST", "/events", {})[0] == 405
+        assert server.respond("GET", "/events?from=3/4", {})[0] == 400
+        assert server.respond("GET", "/messages?tz=Nowhere", {})[0] == 400
+        assert server.respond("GET", "/messages?locale=fr", {})[0] == 400
+
+        # スケジュール側の誤りはクライアントの誤りではない
+        tz = pytz.timezone("Asia/Tokyo")
+        events = [app.Event(start=tz.localize(datetime(2017, 3, 3, h)),
+                            end=tz.localize(datetime(2017, 3, 3, h + 1)),
+                            url=None, title="Open") for h in [10, 17]]
+        server._state = app.ServerState(events, [], {}, {})
+        assert server.respond(
+            "GET", "/messages?date=2017-03-03", {})[0] == 500
+
+    def test_indexes_are_built_off_the_loop(self, server):
+        assert list(server._state.indexes) == [server.notifier.tz]
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(server._prepare("/messages?tz=UTC"))
+            loop.run_until_complete(server._prepare("/messages?tz=Nowhere"))
+        finally:
+            loop.close()
+        assert pytz.utc in server._state.indexes
+
+    def test_serve(self, server):
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start("127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", server.port)
+            for _ in range(2):
+                connection.request("GET", "/events?from=2017-03-10")
+                response = connection.getresponse()
+                assert response.status == 200
+                assert response.getheader("Connection") == "keep-alive"
+                assert json.loads(response.read().decode("utf-8"))[0][
+                    "title"] == "Python Event"
+            connection.close()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.run_until_complete(server.close())
+            loop.close()
+
+
+class TestReminderEngine:
+    def event(self, day, hour, title="Open", url=None):
+        tz = pytz.timezone("Asia/Tokyo")
+        return app.Event(start=tz.localize(datetime(2017, 3, day, hour)),
+                         end=tz.localize(datetime(2017, 3, day, hour + 2)),
+                         url=url, title=title)
+
+    def test_remind_before_start(self):
+        clock = [self.event(3, 8).start.timestamp()]
+        reminded = []
+        engine = app.ReminderEngine(
+            reminded.append, remind_before=timedelta(minutes=30),
+            clock=lambda: clock[0])
+        engine.update([self.event(3, 17), self.event(3, 7),
+                       self.event(4, 17, "Make"), self.event(3, 18, " ")])
+        assert len(engine) == 2
+        first = self.event(3, 17).start.timestamp() - 30 * 60
+        assert engine.run_pending() == first
+        assert reminded == []
+
+        clock[0] = first
+        second = self.event(4, 17).start.timestamp() - 30 * 60
+        assert engine.run_pending() == second
+        assert [e.title for e in reminded] == ["Open"]
+        clock[0] = second + 1
+        assert engine.run_pending() is None
+        assert [e.title for e in reminded] == ["Open", "Make"]
+        assert len(engine) == 0
+
+    def test_update_in_place(self):
+        clock = [self.event(3, 8).start.timestamp()]
+        reminded = []
+        engine = app.ReminderEngine(
+            reminded.append, remind_before=timedelta(minutes=30),
+            clock=lambda: clock[0])
+        engine.update([self.event(3, 17), self.event(4, 17, "Make")])
+        # URL の変更はそのまま反映し、時刻が変わったものは入れ替える
+        engine.update([self.event(3, 17, url="https://example.com/"),
+                       self.event(4, 18, "Make")])
+        assert len(engine) == 2
+        assert engine.next_deadline() == \
+            self.event(3, 17).start.timestamp() - 30 * 60
+        # 消えたイベントには通知しない
+        engine.update([self.event(4, 18, "Make")])
+        assert engine.next_deadline() == \
+            self.event(4, 18).start.timestamp() - 30 * 60
+
+        engine.update([self.event(3, 17, url="https://example.com/"),
+                       self.event(4, 18, "Make")])
+        clock[0] = self.event(5, 0).start.timestamp()
+        engine.run_pending()
+        assert [(e.title, e.start.hour, e.url) for e in reminded] == [
+            ("Open", 17, "https://example.com/"), ("Make", 18, None)]
+
+    def test_run_wakes_up_on_update(self):
+        reminded = threading.Event()
+        engine = app.ReminderEngine(
+            lambda event: reminded.set(), remind_before=timedelta(minutes=30))
+        stop = threading.Event()
+        thread = threading.Thread(target=engine.run, args=(stop,))
+        thread.start()
+        try:
+            # 眠っている間に追加された、より早い期限で起きる
+            start = datetime.fromtimestamp(
+                time.time() + 30 * 60 + 0.2, pytz.utc)
+            engine.update([app.Event(start=start, end=start, url=None,
+                                     title="Open")])
+            assert reminded.wait(5)
+            assert len(engine) == 0
+        finally:
+            stop.set()
+            engine.wakeup()
+            thread.join(5)
+        assert not thread.is_alive()
+
+
+class TestStartup:
+    # 起動時に読み込まない重い依存。-X importtime は 3.7 以降にしかないので、
+    # 時間ではなく読み込まれたモジュールで確かめる
+    HEAVY_MODULES = ["requests", "requests_oauthlib", "dateutil", "pytz",
+                     "numpy", "orjson", "msgspec", "sqlite3", "asyncio"]
+
+    def test_import_does_not_load_heavy_dependencies(self):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, app; print('\\n'.join(sys.modules))"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        modules = set(result.stdout.splitlines())
+        assert "app" in modules
+        for module in self.HEAVY_MODULES:
+            assert module not in modules